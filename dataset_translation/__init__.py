@@ -0,0 +1,33 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Translation of the benchmark datasets to German.
+
+Run a translation from the repository root with ``python -m dataset_translation <dataset>``.
+Importing the package or any of its modules has no side effects; datasets,
+guidance and the model clients are only loaded once a run starts.
+
+Every benchmark is a ``DatasetSpec`` (specs.py) in its ``translate_<name>.py``
+module, all of them are run by ``runner.run_spec``. A new benchmark only
+needs a spec and an entry in ``DATASETS``.
+"""
+
+# dataset name -> module with its DatasetSpec, imported only when it is run
+DATASETS = {
+    "arc": "translate_arc",
+    "hellaswag": "translate_hellaswag",
+    "mmlu": "translate_mmlu",
+    "truthfulqa": "translate_truthfulqa",
+}
@@ -0,0 +1,79 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Command line entry point of the translation scripts:
+
+    python -m dataset_translation arc
+    python -m dataset_translation mmlu --dry-run
+    python -m dataset_translation hellaswag --backend mock --max-rows 50 --no-push
+
+A run on another backend than openai keeps its outputs and state files
+apart from the real ones, e.g. in ``outputs_hellaswag_de.mock`` and
+``translation_cache.mock.sqlite``.
+
+To spread a run over several machines, start it on each of them with the
+same ``--leases`` file and output directory on a shared filesystem, e.g.
+``python -m dataset_translation hellaswag --leases /shared/leases.sqlite``.
+The workers claim row ranges from the lease file and the last one to
+finish merges and pushes the outputs.
+"""
+
+import argparse
+import importlib
+import json
+from . import DATASETS, settings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m dataset_translation",
+                                     description="Translate a benchmark dataset to German.")
+    parser.add_argument("dataset", choices=list(DATASETS))
+    parser.add_argument("--dry-run", action="store_true", help="only print the token and cost estimate")
+    parser.add_argument("--backend", choices=["openai", "direct", "mock", "local"], help="model backend, see backends.py")
+    parser.add_argument("--backend-options", type=json.loads, help="json options for the backend")
+    parser.add_argument("--max-rows", type=int, help="translate at most this many rows per split")
+    parser.add_argument("--no-push", action="store_true", help="keep the outputs local")
+    parser.add_argument("--leases", help="shared lease file, run as one of several workers")
+    parser.add_argument("--worker", help="name of this worker in the lease file")
+    parser.add_argument("--lease-rows", type=int, help="rows per leased range")
+    parser.add_argument("--request-timeout", type=float, help="seconds before a request is cancelled and retried")
+    parser.add_argument("--hedge-budget", type=float,
+                        help="duplicate requests slower than the p95 latency, at most this share of the requests")
+    args = parser.parse_args(argv)
+
+    if args.backend is not None:
+        settings.BACKEND = args.backend
+    if args.backend_options is not None:
+        settings.BACKEND_OPTIONS = args.backend_options
+    if args.max_rows is not None:
+        settings.MAX_ROWS = args.max_rows
+    if args.no_push:
+        settings.PUSH_TO_HUB = False
+    if args.leases is not None:
+        settings.LEASES = args.leases
+    if args.worker is not None:
+        settings.WORKER = args.worker
+    if args.lease_rows is not None:
+        settings.LEASE_ROWS = args.lease_rows
+    if args.request_timeout is not None:
+        settings.REQUEST_TIMEOUT = args.request_timeout
+    if args.hedge_budget is not None:
+        settings.HEDGE_BUDGET = args.hedge_budget
+    from .runner import run_spec
+    run_spec(importlib.import_module(f".{DATASETS[args.dataset]}", __package__).spec, dry_run=args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import contextvars
+import functools
+import json
+import math
+from .prompts import render_messages
+from .rate_limit import estimate_tokens
+
+# USD per 1K tokens (input, output)
+PRICES = {
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-3.5-turbo-0301": (0.0015, 0.002),
+    "gpt-3.5-turbo-0613": (0.0015, 0.002),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-0314": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+}
+
+# chat formatting tokens around every message and before the reply
+_TOKENS_PER_MESSAGE = 4
+_TOKENS_PER_REPLY = 3
+
+# Labels (split, row, depth, ...) of the request being made; every asyncio task sees its own copy
+usage_labels = contextvars.ContextVar("usage_labels", default={})
+
+
+def label(**labels):
+    """Attach labels to all usage recorded from the current task, e.g. ``label(split="train", depth=1)``."""
+    usage_labels.set({**usage_labels.get(), **labels})
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text, model):
+    """Count tokens with the model's tokenizer, or estimate them if tiktoken is not installed."""
+    encoding = _encoding(model)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages, model):
+    return sum(_TOKENS_PER_MESSAGE + count_tokens(message["content"], model) for message in messages) + _TOKENS_PER_REPLY
+
+
+def cost(model, input_tokens, output_tokens):
+    input_price, output_price = PRICES.get(model, (0.0, 0.0))
+    return (input_tokens * input_price + output_tokens * output_price) / 1000
+
+
+def estimate_run(rows, build_inputs, template, model, output_ratio=1.3, retry_rate=0.0, max_depth=0):
+    """
+    Predict the tokens, requests and cost of translating ``rows`` before any request is sent.
+
+    ``build_inputs(row)`` returns the variables the script passes to the
+    program, which are rendered into ``template`` exactly as they will be
+    sent. The output is assumed to be ``output_ratio`` times as long as the
+    inputs (German translations run longer than the English source).
+    ``retry_rate`` is the expected share of rows that are sent again and
+    ``max_depth`` the deepest retry, which bounds the worst case.
+    """
+    estimate = {"rows": 0, "input_tokens": 0, "output_tokens": 0}
+    for row in rows:
+        inputs = build_inputs(row)
+        estimate["rows"] += 1
+        estimate["input_tokens"] += count_message_tokens(render_messages(template, inputs), model)
+        estimate["output_tokens"] += math.ceil(output_ratio * sum(count_tokens(str(value), model)
+                                                                  for value in inputs.values()))
+    estimate["requests"] = math.ceil(estimate["rows"] * (1 + retry_rate))
+    estimate["input_tokens"] = math.ceil(estimate["input_tokens"] * (1 + retry_rate))
+    estimate["output_tokens"] = math.ceil(estimate["output_tokens"] * (1 + retry_rate))
+    estimate["cost"] = cost(model, estimate["input_tokens"], estimate["output_tokens"])
+    estimate["worst_case_cost"] = estimate["cost"] / (1 + retry_rate) * (1 + max_depth)
+    return estimate
+
+
+def format_estimate(name, estimate):
+    return (f"Estimate for {name}: {estimate['requests']} requests, {estimate['input_tokens']} input and "
+            f"{estimate['output_tokens']} output tokens, ${estimate['cost']:.2f} "
+            f"(${estimate['worst_case_cost']:.2f} if every row hits the retry limit)")
+
+
+def _empty_usage():
+    return {"requests": 0, "input_tokens": 0, "output_tokens": 0}
+
+
+class Accountant:
+    """
+    Records the real token usage of every request while a run is going on.
+
+    Prompts and outputs are counted with the model's tokenizer and booked
+    under the labels set with ``label()``, so usage can be broken down per
+    row, split and retry depth. Cached replays are counted separately
+    since they cost nothing.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.totals = {"requests": 0, "cached": 0, "input_tokens": 0, "output_tokens": 0}
+        self.by_split = {}
+        self.by_depth = {}
+        self.by_row = {}
+
+    def record_request(self, template, inputs, output):
+        self.record(count_message_tokens(render_messages(template, inputs), self.model),
+                    count_tokens(output or "", self.model))
+
+    def record_cached(self):
+        self.totals["cached"] += 1
+
+    def record(self, input_tokens, output_tokens):
+        labels = usage_labels.get()
+        entries = [self.totals, self.by_depth.setdefault(labels.get("depth", 0), _empty_usage())]
+        if "split" in labels:
+            entries.append(self.by_split.setdefault(labels["split"], _empty_usage()))
+        if labels.get("row") is not None:
+            entries.append(self.by_row.setdefault((labels.get("split"), labels["row"]), _empty_usage()))
+        for entry in entries:
+            entry["requests"] += 1
+            entry["input_tokens"] += input_tokens
+            entry["output_tokens"] += output_tokens
+
+    def row_usage(self, split, row):
+        return self.by_row.get((split, row), _empty_usage())
+
+    def cost(self, usage=None):
+        usage = usage or self.totals
+        return cost(self.model, usage["input_tokens"], usage["output_tokens"])
+
+    def save(self, path):
+        report = {
+            "model": self.model,
+            "totals": {**self.totals, "cost": self.cost()},
+            "by_split": {str(split): {**usage, "cost": self.cost(usage)} for split, usage in self.by_split.items()},
+            "by_depth": {str(depth): {**usage, "cost": self.cost(usage)} for depth, usage in self.by_depth.items()},
+            "by_row": [{"split": split, "row": row, **usage} for (split, row), usage in self.by_row.items()],
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    def summary(self):
+        text = (f"Usage: {self.totals['requests']} requests ({self.totals['cached']} served from cache), "
+                f"{self.totals['input_tokens']} input and {self.totals['output_tokens']} output tokens, "
+                f"${self.cost():.2f}")
+        for split, usage in self.by_split.items():
+            text += f"\n  {split}: {usage['requests']} requests, ${self.cost(usage):.2f}"
+        for depth, usage in sorted(self.by_depth.items()):
+            if depth:
+                text += f"\n  retry depth {depth}: {usage['requests']} requests, ${self.cost(usage):.2f}"
+        return text
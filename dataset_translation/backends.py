@@ -0,0 +1,405 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Model backends for the translation programs.
+
+A program is anything with the template in ``text`` that can be awaited as
+``await program(async_mode=True, **inputs)`` and returns ``{"output": ...}``,
+which is what ``TranslationEngine`` calls. Programs that see the response
+headers also return them as ``"headers"``, so the rate limiter can pace
+the requests by the quota the API reports. ``load_program`` builds one for
+the configured backend:
+
+    openai  a guidance program run against ``guidance.llm``
+    direct  the same chat request sent straight to the OpenAI api (``{"api_base":
+            ..., "timeout": ...}``, or a pool of ``{"endpoints": [...]}``), the
+            template is compiled into messages once instead of being interpreted
+            by guidance for every row; needs httpx
+    mock    a local simulation of the model, no API key needed
+    local   a self-hosted model, either behind an OpenAI-compatible server
+            (``{"server_url": "http://localhost:8000/v1", "model": ...}``) or
+            loaded in-process (``{"model": ..., "engine": "transformers" or
+            "vllm", "device": "cpu"}``)
+"""
+
+import asyncio
+import json
+import os
+import random
+import re
+from .endpoints import EndpointPool
+from .parsing import parse_lenient
+from .prompts import compile_template, render_messages, generation_options, GEN_DEFAULTS
+from .rate_limit import estimate_tokens
+from . import settings
+
+
+class RateLimitError(Exception):
+    http_status = 429
+
+
+def _apply_stop(output, stop):
+    if stop and stop in output:
+        return output[:output.index(stop)]
+    return output
+
+
+class MockProgram:
+    """
+    Simulated chat model that "translates" the json of the last prompt message.
+
+    Every string value is returned with a ``[de]`` marker, keys are kept.
+    The failure modes of the real model can be switched on with a rate
+    between 0 and 1 each: ``rate_limit_rate`` (429 errors),
+    ``truncate_rate`` (output cut off), ``malformed_rate`` (a quote or
+    bracket goes missing) and ``key_quirk_rate`` (keys translated to
+    "Frage"/"Antworten"). Latency is ``latency`` plus ``latency_per_token``
+    per output token, with log-normal jitter.
+    """
+
+    def __init__(self, text, latency=0.5, latency_per_token=0.0, jitter=0.3, rate_limit_rate=0.0, truncate_rate=0.0,
+                 malformed_rate=0.0, key_quirk_rate=0.0, seed=None):
+        self.text = text
+        self.options = generation_options(text)
+        self.latency = latency
+        self.latency_per_token = latency_per_token
+        self.jitter = jitter
+        self.rate_limit_rate = rate_limit_rate
+        self.truncate_rate = truncate_rate
+        self.malformed_rate = malformed_rate
+        self.key_quirk_rate = key_quirk_rate
+        self.random = random.Random(seed)
+
+    async def __call__(self, async_mode=True, **inputs):
+        messages = render_messages(self.text, inputs)
+        output = self.translate(messages[-1]["content"] if messages else "")
+        await asyncio.sleep(self.latency_for(output))
+        if self.random.random() < self.rate_limit_rate:
+            raise RateLimitError("Rate limit reached for requests (simulated)")
+        return {**inputs, "output": _apply_stop(output, self.options.get("stop"))}
+
+    def latency_for(self, output):
+        latency = self.latency + self.latency_per_token * estimate_tokens(output)
+        return latency * self.random.lognormvariate(0, self.jitter) if self.jitter else latency
+
+    def translate(self, content):
+        # the text to translate is the json at the end of the last message
+        lines = content.split("\n")
+        starts = [i for i, line in enumerate(lines) if line.lstrip().startswith(("{", "["))]
+        source = "\n".join(lines[starts[-1]:]) if starts else content
+        try:
+            value = json.loads(source)
+        except ValueError:
+            value = parse_lenient(source)
+        value = self._translate_value(value)
+        if isinstance(value, dict) and self.random.random() < self.key_quirk_rate:
+            value = {{"question": "Frage", "choices": "Antworten"}.get(key, key): item for key, item in value.items()}
+        output = json.dumps(value, ensure_ascii=False, indent=0 if "\n" in source.strip() else None)
+        if self.random.random() < self.malformed_rate:
+            positions = [match.start() for match in re.finditer(r'[\[\]"]', output)]
+            if positions:
+                position = self.random.choice(positions)
+                output = output[:position] + output[position + 1:]
+        if self.random.random() < self.truncate_rate:
+            output = output[:self.random.randint(0, len(output))]
+        return output
+
+    def _translate_value(self, value):
+        if isinstance(value, str):
+            return f"[de] {value}"
+        if isinstance(value, list):
+            return [self._translate_value(item) for item in value]
+        if isinstance(value, dict):
+            return {key: item if key == "id" else self._translate_value(item) for key, item in value.items()}
+        return value
+
+
+class ChatProgram:
+    """Fills the precompiled chat messages of the template and generates the reply with ``model``."""
+
+    def __init__(self, text, model):
+        self.text = text
+        self.prompt = compile_template(text)
+        self.options = self.prompt.options
+        self.model = model
+
+    async def __call__(self, async_mode=True, **inputs):
+        if isinstance(self.model, ChatClient):
+            output, headers = await self.model.complete(self.prompt.render(inputs), self.options)
+            return {**inputs, "output": output, "headers": headers}
+        output = await self.model.generate(self.prompt.render(inputs), self.options)
+        return {**inputs, "output": output}
+
+
+def read_api_key(api_key):
+    """``api_key`` itself, or the contents of the file it names (as guidance reads it)."""
+    if api_key and os.path.exists(os.path.expanduser(api_key)):
+        with open(os.path.expanduser(api_key)) as f:
+            return f.read().strip()
+    return api_key
+
+
+class ChatClient:
+    """
+    Sends chat completion requests to the OpenAI api without guidance.
+
+    The request is the one guidance sends for the template: the rendered
+    messages and the ``{{gen}}`` options, with guidance's defaults for the
+    options the template leaves out. ``endpoints`` spreads the requests
+    over several api bases and keys (``[{"api_base": ..., "api_key": ...,
+    "model": ...}]``, keys may name a key file), see ``EndpointPool``;
+    otherwise every request goes to ``api_base`` with ``api_key``.
+    Connections are kept alive and reused, over HTTP/2 where the server
+    supports it and the h2 package is installed.
+    """
+
+    def __init__(self, model, api_key=None, api_base="https://api.openai.com/v1", endpoints=None, **options):
+        self.model = model
+        endpoints = endpoints or [{"api_base": api_base, "api_key": api_key or settings.API_KEY}]
+        self.pool = EndpointPool([{**endpoint, "api_key": read_api_key(endpoint.get("api_key"))}
+                                  for endpoint in endpoints], model, **options)
+
+    def request(self, messages, options):
+        options = {**GEN_DEFAULTS, **options}
+        body = {"model": self.model, "messages": messages, "temperature": options["temperature"],
+                "top_p": options["top_p"], "max_tokens": options["max_tokens"], "n": 1}
+        if options.get("stop"):
+            body["stop"] = options["stop"]
+        return body
+
+    async def complete(self, messages, options):
+        """The reply and the response headers, None for a pool whose keys each report their own quota."""
+        response, headers = await self.pool.post("/chat/completions", self.request(messages, options))
+        return response["choices"][0]["message"]["content"], headers if len(self.pool.endpoints) == 1 else None
+
+    async def generate(self, messages, options):
+        output, _ = await self.complete(messages, options)
+        return output
+
+    def summary(self):
+        return self.pool.summary()
+
+
+class OpenAICompatibleServer:
+    """
+    A model behind an OpenAI-compatible chat endpoint (vLLM, TGI, llama.cpp, ...).
+
+    Requests are sent concurrently as they come in; these servers batch
+    concurrent requests on the GPU themselves (continuous batching), so
+    no client-side batching is needed.
+    """
+
+    def __init__(self, server_url, model, api_key="EMPTY"):
+        self.server_url = server_url
+        self.model = model
+        self.api_key = api_key
+
+    async def generate(self, messages, options):
+        import openai
+        response = await openai.ChatCompletion.acreate(
+            model=self.model, messages=messages, api_base=self.server_url, api_key=self.api_key,
+            temperature=options.get("temperature", 0), top_p=options.get("top_p", 1),
+            max_tokens=options.get("max_tokens"), stop=options.get("stop"),
+        )
+        return response["choices"][0]["message"]["content"]
+
+
+class BatchedModel:
+    """
+    Collects concurrent ``generate`` calls into batches for an in-process model.
+
+    A batch is run as soon as ``max_batch_size`` prompts are waiting or
+    ``flush_interval`` seconds after the first one arrived; prompts with
+    different generation options (e.g. temperature) go into separate
+    batches. Generation runs in a worker thread so the event loop keeps
+    reading and writing rows. Subclasses implement
+    ``_generate(messages_list, options)``.
+    """
+
+    def __init__(self, max_batch_size=16, flush_interval=0.05):
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.pending = []
+        self._timer = None
+        self._lock = None
+        self._loop = None
+        self.batches = 0
+        self.prompts = 0
+
+    async def generate(self, messages, options):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((messages, options, future))
+        if len(self.pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.flush_interval, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        groups = {}
+        for request in self.pending:
+            groups.setdefault(json.dumps(request[1], sort_keys=True), []).append(request)
+        self.pending = []
+        for group in groups.values():
+            for start in range(0, len(group), self.max_batch_size):
+                asyncio.ensure_future(self._run(group[start:start + self.max_batch_size]))
+
+    async def _run(self, batch):
+        # one batch on the model at a time, the next one is collected meanwhile
+        if self._loop is not asyncio.get_running_loop():
+            self._loop = asyncio.get_running_loop()
+            self._lock = asyncio.Lock()
+        options = batch[0][1]
+        async with self._lock:
+            try:
+                outputs = await asyncio.to_thread(self._generate, [messages for messages, _, _ in batch], options)
+            except Exception as e:
+                for _, _, future in batch:
+                    # hedged or timed-out requests cancel their future
+                    if not future.done():
+                        future.set_exception(e)
+                return
+        self.batches += 1
+        self.prompts += len(batch)
+        for (_, _, future), output in zip(batch, outputs):
+            if not future.done():
+                future.set_result(_apply_stop(output, options.get("stop")))
+
+    def _generate(self, messages_list, options):
+        raise NotImplementedError
+
+
+class TransformersModel(BatchedModel):
+    """In-process Hugging Face model, also usable on CPU for small models."""
+
+    def __init__(self, model, device="cpu", torch_dtype=None, max_new_tokens=1024, **kwargs):
+        super().__init__(**kwargs)
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+        self.tokenizer = AutoTokenizer.from_pretrained(model, padding_side="left")
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = AutoModelForCausalLM.from_pretrained(model, torch_dtype=torch_dtype or "auto").to(device)
+        self.model.eval()
+        self.device = device
+        self.max_new_tokens = max_new_tokens
+
+    def _generate(self, messages_list, options):
+        import torch
+        prompts = [self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+                   for messages in messages_list]
+        inputs = self.tokenizer(prompts, return_tensors="pt", padding=True, add_special_tokens=False).to(self.device)
+        temperature = options.get("temperature", 0)
+        sampling = {"do_sample": True, "temperature": temperature, "top_p": options.get("top_p", 1)} \
+            if temperature > 0 else {"do_sample": False}
+        max_new_tokens = options.get("max_tokens", self.max_new_tokens)
+        with torch.no_grad():
+            generated = self.model.generate(**inputs, max_new_tokens=max_new_tokens,
+                                            pad_token_id=self.tokenizer.pad_token_id, **sampling)
+        return self.tokenizer.batch_decode(generated[:, inputs["input_ids"].shape[1]:], skip_special_tokens=True)
+
+
+class VLLMModel(BatchedModel):
+    """In-process vLLM engine, every batch is handed to vLLM's scheduler in one call."""
+
+    def __init__(self, model, max_batch_size=256, flush_interval=0.05, **engine_kwargs):
+        super().__init__(max_batch_size=max_batch_size, flush_interval=flush_interval)
+        from vllm import LLM
+        self.llm = LLM(model=model, **engine_kwargs)
+
+    def _generate(self, messages_list, options):
+        from vllm import SamplingParams
+        tokenizer = self.llm.get_tokenizer()
+        prompts = [tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+                   for messages in messages_list]
+        params = SamplingParams(temperature=options.get("temperature", 0), top_p=options.get("top_p", 1),
+                                max_tokens=options.get("max_tokens", 1024),
+                                stop=[options["stop"]] if options.get("stop") else None)
+        return [result.outputs[0].text for result in self.llm.generate(prompts, params, use_tqdm=False)]
+
+
+_LOCAL_ENGINES = {"transformers": TransformersModel, "vllm": VLLMModel}
+# every program of a run shares one loaded model or client
+_local_models = {}
+_chat_clients = {}
+
+
+def local_model(server_url=None, model=None, engine="transformers", **options):
+    key = json.dumps({"server_url": server_url, "model": model, "engine": engine, **options}, sort_keys=True)
+    if key not in _local_models:
+        if server_url is not None:
+            _local_models[key] = OpenAICompatibleServer(server_url, model, **options)
+        else:
+            _local_models[key] = _LOCAL_ENGINES[engine](model, **options)
+    return _local_models[key]
+
+
+def client_summaries():
+    """Summaries of the api clients of the run, e.g. the state of every endpoint of a pool."""
+    return [client.summary() for client in _chat_clients.values()]
+
+
+def close_clients():
+    """Close the connections of the api clients of the run."""
+    async def close():
+        for client in _chat_clients.values():
+            await client.pool.aclose()
+
+    if _chat_clients:
+        asyncio.run(close())
+
+
+def chat_client(model, **options):
+    key = json.dumps({"model": model, **options}, sort_keys=True)
+    if key not in _chat_clients:
+        _chat_clients[key] = ChatClient(model, **options)
+    return _chat_clients[key]
+
+
+def backend_model(model_name, backend=None):
+    """The model that answers the requests on ``backend``, which may differ from the model of the run."""
+    backend = backend or settings.BACKEND
+    options = settings.BACKEND_OPTIONS
+    if backend == "direct":
+        return options.get("model") or model_name
+    if backend == "local":
+        return options.get("model") or options.get("server_url") or model_name
+    if backend == "mock":
+        return "mock"
+    return model_name
+
+
+def load_program(text, backend=None, model_name=None, **options):
+    """
+    Build the program for ``text`` on ``backend`` (default: ``settings.BACKEND``).
+
+    ``model_name`` is the model of the run, used by the backends that do not
+    read it from ``guidance.llm`` or their options.
+    """
+    backend = backend or settings.BACKEND
+    options = {**settings.BACKEND_OPTIONS, **options}
+    if backend == "openai":
+        import guidance
+        return guidance(text, stream=False)
+    if backend == "direct":
+        return ChatProgram(text, chat_client(options.pop("model", model_name), **options))
+    if backend == "mock":
+        return MockProgram(text, **options)
+    if backend == "local":
+        return ChatProgram(text, local_model(**options))
+    raise ValueError(f"Unknown backend {backend!r}")
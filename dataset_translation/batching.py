@@ -0,0 +1,193 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import json
+import re
+import time
+from .rate_limit import estimate_tokens
+from .accounting import label
+
+
+def parse_items(output, texts=None):
+    """
+    Parse a JSON list of ``{"id": ..., ...}`` objects into a dict keyed by id.
+
+    If the list as a whole is malformed, every object that still decodes on
+    its own is kept, so only the broken items have to be retried. ``texts``,
+    if given, is filled with the raw text of every parsed object by id.
+    """
+    if texts is None:
+        try:
+            items = json.loads(output)
+            if isinstance(items, list):
+                return {item["id"]: item for item in items if isinstance(item, dict) and "id" in item}
+        except Exception:
+            pass
+    decoder = json.JSONDecoder()
+    items = {}
+    position = output.find("{")
+    while position != -1:
+        try:
+            item, end = decoder.raw_decode(output, position)
+        except ValueError:
+            position = output.find("{", position + 1)
+            continue
+        if isinstance(item, dict) and "id" in item:
+            items[item["id"]] = item
+            if texts is not None:
+                texts[item["id"]] = output[position:end]
+        position = output.find("{", end)
+    return items
+
+
+def _without_id(text, id):
+    """The raw text of an item without the ``"id"`` key the batch added to it."""
+    return re.sub(rf'"id"\s*:\s*{id}\s*,\s*|,\s*"id"\s*:\s*{id}\s*(?=\}}$)', "", text, count=1)
+
+
+def _report_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        error = task.exception()
+        print(f"Batch request failed: {type(error).__name__}: {error}")
+
+
+class AdaptiveBatcher:
+    """
+    Packs up to K examples into a single request for a batched program.
+
+    Callers ``await submit(item)`` one example at a time and get back the
+    translated item and its raw text from the response, or ``None`` if it
+    could not be translated as part of a batch (the caller then falls back to the one-row-per-call path). K grows
+    by one after every fully parsed batch, halves after a batch with parse
+    failures and is always capped so the estimated batch size stays within
+    ``max_batch_tokens``. Items that fail inside a batch are split off and
+    retried in smaller batches on their own. If a batch fails with an
+    error, its callers get the error instead of waiting forever.
+    ``is_valid(item, translated)``
+    decides whether an item came back usable, and ``extra_inputs(items)``
+    can add further program variables (e.g. hints) for a batch.
+    """
+
+    def __init__(self, engine, is_valid, estimate_single, extra_inputs=None, initial_size=8, max_size=32,
+                 max_batch_tokens=1500, flush_interval=0.05):
+        self.engine = engine
+        self.is_valid = is_valid
+        self.estimate_single = estimate_single
+        self.extra_inputs = extra_inputs
+        self.size = initial_size
+        self.max_size = max_size
+        self.max_batch_tokens = max_batch_tokens
+        self.flush_interval = flush_interval
+        self.pending = []
+        self._timer = None
+        self.requests = 0
+        self.failed_batches = 0
+        self.translated = 0
+        self.batched_tokens = 0
+        self.single_tokens = 0
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((item, future))
+        if len(self.pending) >= self.size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self._flush)
+        return await future
+
+    def _take(self):
+        batch, tokens = [], 0
+        while self.pending and len(batch) < self.size:
+            item_tokens = 2 * estimate_tokens(json.dumps(self.pending[0][0], ensure_ascii=False))
+            if batch and tokens + item_tokens > self.max_batch_tokens:
+                break
+            batch.append(self.pending.pop(0))
+            tokens += item_tokens
+        return batch
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self.pending:
+            self._start(self._take())
+
+    def _start(self, batch):
+        task = asyncio.ensure_future(self._run(batch))
+        task.add_done_callback(_report_failure)
+        return task
+
+    async def _run(self, batch):
+        try:
+            await self._translate(batch)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            raise
+
+    async def _translate(self, batch):
+        # a batch is shared by several rows, so its usage is not booked on the row that filled it
+        label(row=None)
+        payload = [{"id": i, **item} for i, (item, _) in enumerate(batch)]
+        inputs = {"input": json.dumps(payload, ensure_ascii=False)}
+        if self.extra_inputs is not None:
+            inputs.update(self.extra_inputs([item for item, _ in batch]))
+        self.requests += 1
+        self.batched_tokens += self.engine.estimate_request_tokens(inputs)
+        try:
+            out = await self.engine(**inputs)
+        except Exception:
+            out = {"output": ""}
+        start = time.perf_counter()
+        texts = {}
+        parsed = parse_items(out.get("output") or "", texts)
+        if self.engine.metrics is not None:
+            outcome = "complete" if len(parsed) == len(batch) else "partial" if parsed else "failed"
+            self.engine.metrics.observe_parse(time.perf_counter() - start, outcome)
+
+        failed = []
+        for i, (item, future) in enumerate(batch):
+            translated = parsed.get(i)
+            if translated is not None and self.is_valid(item, translated):
+                translated.pop("id")
+                self.translated += 1
+                self.single_tokens += self.estimate_single(item)
+                if not future.done():
+                    future.set_result((translated, _without_id(texts[i], i)))
+            else:
+                failed.append((item, future))
+
+        if not failed:
+            self.size = min(self.max_size, self.size + 1)
+            return
+        self.engine.forget(**inputs)
+        self.failed_batches += 1
+        self.size = max(1, self.size // 2)
+        if len(batch) == 1:
+            if not batch[0][1].done():
+                batch[0][1].set_result(None)
+            return
+        half = (len(failed) + 1) // 2
+        # each half settles its own rows, an error in one does not cut the other short
+        await asyncio.wait([self._start(part) for part in (failed[:half], failed[half:]) if part])
+
+    def summary(self):
+        saved = (self.single_tokens - self.batched_tokens) / self.translated if self.translated else 0.0
+        return (f"Batched {self.translated} rows in {self.requests} requests "
+                f"({self.failed_batches} with parse failures, current K={self.size}), "
+                f"~{saved:.0f} tokens saved per row vs. one row per call")
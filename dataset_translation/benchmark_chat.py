@@ -0,0 +1,233 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Per-call overhead of the guidance programs against the direct chat path.
+
+Both paths send the requests of one script's template to a stub
+OpenAI-compatible server in a child process that answers immediately, so
+what is measured is the client side: template interpretation, building the
+request and reading the response. The server records every request body,
+and both paths have to send the same requests and return the same outputs:
+
+    python -m dataset_translation.benchmark_chat --dataset mmlu --calls 500 --concurrency 64
+
+Memory per worker is the traced peak allocation while ``--concurrency``
+requests are in flight, divided by the number of requests.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import importlib
+import json
+import multiprocessing
+import threading
+import time
+import tracemalloc
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from . import DATASETS
+from .backends import ChatClient, ChatProgram
+
+# the request fields that decide the output, guidance adds a few of its own (e.g. stream, logit_bias)
+REQUEST_FIELDS = ["model", "messages", "temperature", "top_p", "max_tokens", "stop", "n"]
+
+
+def stub_output(body):
+    return "[de] " + hashlib.sha256(json.dumps(body["messages"], sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    requests = []
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.requests.append(body)
+        output = stub_output(body)
+        if body.get("stream"):
+            chunks = [{"role": "assistant"}, {"content": output}, {}]
+            payload = "".join(
+                "data: " + json.dumps({"choices": [{"index": 0, "delta": delta,
+                                                    "finish_reason": None if delta else "stop"}]}) + "\n\n"
+                for delta in chunks
+            ) + "data: [DONE]\n\n"
+            self._send(payload.encode("utf-8"), "text/event-stream")
+            return
+        response = {
+            "object": "chat.completion",
+            "model": body.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": output}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }
+        self._send(json.dumps(response).encode("utf-8"), "application/json")
+
+    def do_GET(self):
+        # hands out and forgets the requests recorded so far
+        recorded = list(self.requests)
+        del self.requests[:len(recorded)]
+        self._send(json.dumps(recorded).encode("utf-8"), "application/json")
+
+    def _send(self, payload, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    # every worker opens its connection at once
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def serve(port, ready):
+    server = StubServer(("127.0.0.1", port), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    ready.set()
+    threading.Event().wait()
+
+
+def recorded_requests(url):
+    with urllib.request.urlopen(f"{url}/requests") as response:
+        return json.loads(response.read())
+
+
+def normalize(body):
+    request = {field: body.get(field) for field in REQUEST_FIELDS}
+    if isinstance(request["stop"], str):
+        request["stop"] = [request["stop"]]
+    request["temperature"] = float(request["temperature"] or 0)
+    request["top_p"] = float(request["top_p"] if request["top_p"] is not None else 1)
+    return json.dumps(request, sort_keys=True, ensure_ascii=False)
+
+
+def sample_inputs(spec, calls):
+    """Program inputs shaped like the rows of ``spec``, every call with different text."""
+    inputs = []
+    for i in range(calls):
+        sentence = f"Which of these statements about sample {i} is correct, given the reasons above?"
+        source = {field: [f"Answer {j} to sample {i} is the one" for j in range(4)] if kind is list else sentence
+                  for field, kind in spec.fields.items()}
+        inputs.append(spec.inputs(source))
+    return inputs
+
+
+def guidance_program(template, model, url):
+    import guidance
+    guidance.llm = guidance.llms.OpenAI(model, api_key="sk-benchmark", api_base=url, caching=False,
+                                        max_calls_per_min=10**9)
+    program = guidance(template, stream=False)
+
+    async def call(**inputs):
+        out = await program(async_mode=True, **inputs)
+        return out["output"]
+
+    return call
+
+
+def direct_program(template, model, url):
+    program = ChatProgram(template, ChatClient(model, api_key="sk-benchmark", api_base=url))
+
+    async def call(**inputs):
+        out = await program(**inputs)
+        return out["output"]
+
+    return call
+
+
+PATHS = {"guidance": guidance_program, "direct": direct_program}
+
+
+def measure(call, inputs, concurrency):
+    async def run():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(kwargs):
+            async with semaphore:
+                return await call(**kwargs)
+
+        # the first calls open the connections and fill the caches of both paths
+        await asyncio.gather(*[one(kwargs) for kwargs in inputs[:concurrency]])
+        start, cpu_start = time.perf_counter(), time.process_time()
+        outputs = await asyncio.gather(*[one(kwargs) for kwargs in inputs])
+        elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+        # tracing slows every allocation down, so memory is measured in a separate round
+        tracemalloc.start()
+        await asyncio.gather(*[one(kwargs) for kwargs in inputs[:concurrency]])
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return outputs, {
+            "ms_per_call": 1000 * elapsed / len(inputs),
+            "cpu_ms_per_call": 1000 * cpu / len(inputs),
+            "calls_per_second": len(inputs) / elapsed if elapsed else 0.0,
+            "kb_per_worker": peak / 1024 / min(concurrency, len(inputs)),
+        }
+
+    return asyncio.run(run())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the per-call overhead of guidance and the direct chat path.")
+    parser.add_argument("--dataset", default="arc", choices=list(DATASETS))
+    parser.add_argument("--paths", nargs="+", default=list(PATHS), choices=list(PATHS))
+    parser.add_argument("--calls", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", default=None, help="write the results to this json file")
+    args = parser.parse_args()
+
+    spec = importlib.import_module(f".{DATASETS[args.dataset]}", __package__).spec
+    url = f"http://127.0.0.1:{args.port}/v1"
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=(args.port, ready), daemon=True)
+    server.start()
+    ready.wait()
+
+    inputs = sample_inputs(spec, args.calls)
+    results, requests, outputs = {}, {}, {}
+    try:
+        for path in args.paths:
+            call = PATHS[path](spec.template, spec.model_name, url)
+            recorded_requests(url)
+            results[path] = {}
+            for concurrency in sorted({1, args.concurrency}):
+                outputs[path], results[path][f"concurrency_{concurrency}"] = measure(call, inputs, concurrency)
+            requests[path] = sorted(normalize(body) for body in recorded_requests(url))
+            result = results[path]
+            print(f"{path:>9}: " + " | ".join(
+                f"{name.replace('_', ' ')}: {stats['ms_per_call']:.2f} ms/call, {stats['cpu_ms_per_call']:.2f} ms cpu, "
+                f"{stats['calls_per_second']:.0f} calls/s, {stats['kb_per_worker']:.1f} KB/worker"
+                for name, stats in result.items()
+            ))
+    finally:
+        server.terminate()
+
+    if len(requests) == 2:
+        results["same_requests"] = requests["guidance"] == requests["direct"]
+        results["same_outputs"] = outputs["guidance"] == outputs["direct"]
+        print(f"same requests: {results['same_requests']}, same outputs: {results['same_outputs']}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
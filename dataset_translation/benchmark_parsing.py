@@ -0,0 +1,136 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Benchmark the lenient parser against the previous json.loads/split()-based
+repair chains on the raw model outputs recorded in the published datasets.
+
+    python -m dataset_translation.benchmark_parsing --limit 5000
+"""
+
+import argparse
+import json
+import time
+from .parsing import (extract_fields, ARC_FIELDS, HELLASWAG_FIELDS, MMLU_FIELDS, TRUTHFULQA_FIELDS,
+                     TRUTHFULQA_ALIASES)
+
+
+def legacy_json(text, fields, aliases=None):
+    translated = json.loads(text)
+    aliases = aliases or {}
+    return {field: next((translated[k] for k in [field] + aliases.get(field, []) if k in translated), None)
+            for field in fields}
+
+
+def legacy_hellaswag(text):
+    # json.loads, then the fix1/fix2/fix3 chain from translate_hellaswag.py
+    candidates = [text, text + "}", text.replace('"endings":', '"endings": [')]
+    if "}" in text and len(text.split("}")[1]) > 0:
+        candidates.append(text.split("}")[0] + "}")
+    for candidate in candidates:
+        try:
+            return legacy_json(candidate, HELLASWAG_FIELDS)
+        except Exception:
+            continue
+    raise ValueError("unparsable")
+
+
+def legacy_mmlu(text):
+    # get_json/get_question/get_choices from translate_mmlu.py
+    def fix_parentheses(string):
+        return string.replace("{", "\\{").replace("}", "\\}")
+
+    def fix_quotes(string):
+        if string[0] == "\"":
+            string = string[1:]
+        if string[-1] == "\"":
+            string = string[:-1]
+        return string.replace("\"", "\\\"").replace("\n", "\\n")
+
+    string = text + "\n}"
+    try:
+        question = string.split("\"question\":")[1].split("\"A\"")[0].strip()
+        if question[0] == "\"":
+            question = question[1:]
+        if question[-2:] == "\",":
+            question = question[:-2]
+        question = fix_parentheses(question.replace("\"", "\\\"").replace("\n", "\\n").replace("\\\",\\n\\\"", "\\n"))
+        choices = [string.split("\"A\":")[1].split("\"B\"")[0].strip()[:-1],
+                   string.split("\"B\":")[1].split("\"C\"")[0].strip()[:-1],
+                   string.split("\"C\":")[1].split("\"D\"")[0].strip()[:-1],
+                   string.split("\"D\":")[1].split("}")[0].strip().rstrip(",")]
+        choices = [fix_quotes(fix_parentheses(choice)) for choice in choices]
+        rebuilt = "{" + f'"question": "{question}", "A": "{choices[0]}", "B": "{choices[1]}", "C": "{choices[2]}", "D": "{choices[3]}"' + "}"
+        return legacy_json(rebuilt, MMLU_FIELDS)
+    except Exception:
+        return legacy_json("{" + text.split("{")[1], MMLU_FIELDS)
+
+
+BENCHMARKS = {
+    "arc": ("bjoernp/arc_challenge_de", ["translation_de"], ARC_FIELDS, None,
+            lambda text: legacy_json(text, ARC_FIELDS)),
+    "hellaswag": ("bjoernp/hellaswag_de", ["translation_de"], HELLASWAG_FIELDS, None, legacy_hellaswag),
+    "mmlu": ("bjoernp/mmlu_de", ["answer_de"], MMLU_FIELDS, None, legacy_mmlu),
+    "truthfulqa": ("bjoernp/truthful_qa_de", ["translation_de1", "translation_de2"], TRUTHFULQA_FIELDS,
+                   TRUTHFULQA_ALIASES, lambda text: legacy_json(text, TRUTHFULQA_FIELDS, TRUTHFULQA_ALIASES)),
+}
+
+
+def run(name, texts, fields, aliases, legacy):
+    results = {}
+    parsers = {
+        "legacy": legacy,
+        "lenient": lambda text: extract_fields(text, fields, aliases),
+    }
+    for parser_name, parser in parsers.items():
+        ok = 0
+        start = time.perf_counter()
+        for text in texts:
+            try:
+                parsed = parser(text)
+            except Exception:
+                continue
+            if all(value is not None for value in parsed.values()):
+                ok += 1
+        elapsed = time.perf_counter() - start
+        results[parser_name] = (ok / len(texts), elapsed / len(texts) * 1e6)
+    for parser_name, (rate, micros) in results.items():
+        print(f"{name:>10} {parser_name:>8}: {rate:7.2%} parsed, {micros:8.1f} µs/row over {len(texts)} rows")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark parsing of recorded raw translations.")
+    parser.add_argument("--datasets", nargs="+", default=list(BENCHMARKS), choices=list(BENCHMARKS))
+    parser.add_argument("--limit", type=int, default=None, help="maximum number of rows per dataset")
+    args = parser.parse_args()
+
+    from datasets import load_dataset
+    for name in args.datasets:
+        path, columns, fields, aliases, legacy = BENCHMARKS[name]
+        dataset = load_dataset(path)
+        texts = []
+        for split in dataset:
+            for column in columns:
+                if column in dataset[split].column_names:
+                    texts.extend(text for text in dataset[split][column] if text)
+        if args.limit is not None:
+            texts = texts[:args.limit]
+        if not texts:
+            print(f"{name:>10}: no recorded raw outputs found")
+            continue
+        run(name, texts, fields, aliases, legacy)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+End-to-end throughput benchmark of the translation scripts against the mock
+backend, no API key needed. Every script runs in a fresh directory (empty
+caches and checkpoints) and is measured for rows per second, peak memory
+and how many extra requests retries and repairs cost:
+
+    python -m dataset_translation.benchmark_pipeline --rows 200 --latency 0.3 --malformed 0.05 --truncate 0.05
+
+The datasets are read through the local Hugging Face cache, set
+HF_DATASETS_OFFLINE=1 once they have been downloaded.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from . import DATASETS
+
+
+def count_rows(directory):
+    # every translated row is recorded once in a writer checkpoint
+    return sum(sum(1 for line in open(path) if line.endswith("\n")) for path in Path(directory).rglob("*.done"))
+
+
+def request_stats(path):
+    statuses, parses = {}, {}
+    if path.exists():
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                event = json.loads(line)
+                if event["event"] == "request":
+                    statuses[event["status"]] = statuses.get(event["status"], 0) + 1
+                else:
+                    parses[event["outcome"]] = parses.get(event["outcome"], 0) + 1
+    return statuses, parses
+
+
+def run(name, options, rows, keep=False):
+    directory = tempfile.mkdtemp(prefix=f"benchmark_{name}_")
+    env = {
+        **os.environ,
+        "TRANSLATION_BACKEND": "mock",
+        "TRANSLATION_BACKEND_OPTIONS": json.dumps(options),
+        "TRANSLATION_MAX_ROWS": str(rows),
+        "TRANSLATION_PUSH_TO_HUB": "0",
+        # the package is run from the temporary directory
+        "PYTHONPATH": os.pathsep.join(filter(None, [str(Path(__file__).resolve().parent.parent),
+                                                     os.environ.get("PYTHONPATH")])),
+    }
+    start = time.perf_counter()
+    with open(Path(directory) / "log.txt", "w") as log:
+        process = subprocess.Popen([sys.executable, "-m", __package__, name], cwd=directory, env=env, stdout=log,
+                                   stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+        _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    translated = count_rows(directory)
+    statuses, parses = request_stats(Path(directory) / f"metrics_{name}.jsonl")
+    sent = sum(count for status, count in statuses.items() if status != "cached")
+    result = {
+        "dataset": name,
+        "exit_code": os.waitstatus_to_exitcode(status),
+        "rows": translated,
+        "seconds": elapsed,
+        "rows_per_second": translated / elapsed if elapsed else 0.0,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_memory_mb": usage.ru_maxrss / 1024,
+        "requests": sent,
+        "requests_per_row": sent / translated if translated else 0.0,
+        "statuses": statuses,
+        "parses": parses,
+        "directory": directory,
+    }
+    if not keep and result["exit_code"] == 0:
+        shutil.rmtree(directory)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the translation scripts offline against the mock backend.")
+    parser.add_argument("--datasets", nargs="+", default=list(DATASETS), choices=list(DATASETS))
+    parser.add_argument("--rows", type=int, default=100, help="rows per split (per subject for mmlu)")
+    parser.add_argument("--latency", type=float, default=0.5, help="mean mock latency per request in seconds")
+    parser.add_argument("--latency-per-token", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="share of requests answered with a 429")
+    parser.add_argument("--truncate", type=float, default=0.0, help="share of outputs that are cut off")
+    parser.add_argument("--malformed", type=float, default=0.0, help="share of outputs with broken json")
+    parser.add_argument("--key-quirks", type=float, default=0.0, help="share of outputs with translated keys")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help="keep the output directories")
+    parser.add_argument("--output", default=None, help="write the results to this json file")
+    args = parser.parse_args()
+
+    options = {
+        "latency": args.latency,
+        "latency_per_token": args.latency_per_token,
+        "rate_limit_rate": args.rate_limit,
+        "truncate_rate": args.truncate,
+        "malformed_rate": args.malformed,
+        "key_quirk_rate": args.key_quirks,
+        "seed": args.seed,
+    }
+    results = []
+    for name in args.datasets:
+        result = run(name, options, args.rows, args.keep)
+        results.append(result)
+        if result["exit_code"] != 0:
+            print(f"{name:>10}: failed with exit code {result['exit_code']}, see {result['directory']}/log.txt")
+            continue
+        print(f"{name:>10}: {result['rows']} rows in {result['seconds']:.1f}s ({result['rows_per_second']:.1f} rows/s), "
+              f"peak memory {result['peak_memory_mb']:.0f} MB, {result['requests_per_row']:.2f} requests/row "
+              f"{result['statuses']} parses {result['parses']}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
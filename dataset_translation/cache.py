@@ -0,0 +1,66 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import hashlib
+import json
+import sqlite3
+import time
+
+
+class TranslationCache:
+    """
+    Persistent content-addressed cache of model outputs.
+
+    Entries are keyed by a hash of the prompt template (which carries the
+    sampling parameters), the backend, the model name and the program inputs, and are
+    committed as soon as a request finishes. Re-running a script after a
+    crash therefore only sends the requests that never completed.
+    """
+
+    def __init__(self, model, backend="openai", path="translation_cache.sqlite"):
+        self.model = model
+        self.backend = backend
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS outputs (key TEXT PRIMARY KEY, output TEXT, created REAL)"
+        )
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, template, inputs):
+        payload = json.dumps([template, self.backend, self.model, inputs], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        row = self.conn.execute("SELECT output FROM outputs WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def put(self, key, output):
+        self.conn.execute("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?)", (key, output, time.time()))
+
+    def delete(self, key):
+        self.conn.execute("DELETE FROM outputs WHERE key = ?", (key,))
+
+    def summary(self):
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        return f"Translation cache: {self.hits}/{total} hits ({rate:.0%})"
@@ -0,0 +1,259 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+A pool of chat endpoints (api bases and keys) with connection reuse, load
+balancing and ejection of failing endpoints.
+"""
+
+import asyncio
+import importlib.util
+import random
+import time
+from urllib.parse import urlparse
+from .rate_limit import parse_duration, parse_retry_after
+
+# statuses worth trying on another endpoint, the others are errors of the request itself
+_RETRY_STATUSES = {408, 409, 500, 502, 503, 504}
+# a rejected key does not recover by itself
+_KEY_STATUSES = {401, 403}
+
+
+async def _close_with_loop(client):
+    # asyncio.run cancels the tasks that are left before it closes the loop, the client is closed in its own loop
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await client.aclose()
+
+
+class EndpointError(Exception):
+    def __init__(self, message, http_status=None, headers=None):
+        super().__init__(message)
+        self.http_status = http_status
+        self.headers = headers or {}
+
+
+class Endpoint:
+    """
+    One api base and key of the pool, with the state the balancing uses.
+
+    ``latency`` is an exponential moving average of the request latency,
+    ``quota()`` the smaller share of the requests and tokens the last
+    response headers reported as remaining (1.0 before any headers were
+    seen). An endpoint is ejected after ``max_failures`` failures in a row,
+    for ``ejection_seconds`` doubling on every ejection up to
+    ``max_ejection_seconds``. After that it is on probation: a single
+    request is sent to it, and the endpoint is back in the pool once that
+    one succeeds. ``http2`` defaults to whether the h2 package is installed.
+    """
+
+    def __init__(self, api_base, api_key, model, http2=None, timeout=600, max_connections=256, max_failures=3,
+                 ejection_seconds=10, max_ejection_seconds=300):
+        self.api_base = api_base.rstrip("/")
+        self.api_key = api_key
+        self.model = model
+        # httpx raises ImportError for http2 without h2
+        self.http2 = importlib.util.find_spec("h2") is not None if http2 is None else http2
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.max_failures = max_failures
+        self.ejection_seconds = ejection_seconds
+        self.max_ejection_seconds = max_ejection_seconds
+        self.name = f"{urlparse(self.api_base).netloc or self.api_base}" + (f" ...{api_key[-4:]}" if api_key else "")
+        self.latency = None
+        self.remaining = {}
+        self.limits = {}
+        self.limited_until = 0.0
+        self.in_flight = 0
+        self.failures = 0
+        self.ejection_level = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.probing = False
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self._client = None
+        self._loop = None
+        self._closer = None
+
+    def client(self):
+        import httpx
+        # one keep-alive connection pool per event loop, shared by every request to this endpoint
+        if self._loop is not asyncio.get_running_loop():
+            self.discard_client()
+            self._loop = asyncio.get_running_loop()
+            self._client = httpx.AsyncClient(
+                base_url=self.api_base, timeout=self.timeout, http2=self.http2,
+                headers={"Authorization": f"Bearer {self.api_key}"} if self.api_key else None,
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections, keepalive_expiry=60),
+            )
+            self._closer = self._loop.create_task(_close_with_loop(self._client))
+        return self._client
+
+    def discard_client(self):
+        """Close the client of an earlier event loop, in that loop if it is still running."""
+        if self._client is not None and not self._client.is_closed and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._closer.cancel)
+        self._client = self._loop = self._closer = None
+
+    async def aclose(self):
+        if self._client is not None and self._loop is asyncio.get_running_loop():
+            self._closer.cancel()
+            await self._client.aclose()
+        self.discard_client()
+
+    def available(self, now):
+        if now < self.limited_until:
+            return False
+        if now < self.ejected_until:
+            return False
+        # an endpoint on probation gets one request at a time until it succeeds
+        return not (self.probing and self.in_flight)
+
+    def quota(self):
+        shares = [self.remaining[kind] / self.limits[kind]
+                  for kind in ("requests", "tokens") if self.limits.get(kind) and kind in self.remaining]
+        return max(0.0, min(shares)) if shares else 1.0
+
+    def score(self, default_latency):
+        # expected share of the quota per second of waiting, queued requests wait behind the ones in flight
+        latency = self.latency if self.latency is not None else default_latency
+        return (0.01 + self.quota()) / (latency * (1 + self.in_flight))
+
+    def observe(self, headers):
+        for kind in ("requests", "tokens"):
+            if f"x-ratelimit-remaining-{kind}" in headers:
+                self.remaining[kind] = float(headers[f"x-ratelimit-remaining-{kind}"])
+            if f"x-ratelimit-limit-{kind}" in headers:
+                self.limits[kind] = float(headers[f"x-ratelimit-limit-{kind}"])
+
+    def succeeded(self, latency, epoch):
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        self.failures = 0
+        if self.probing and epoch == self.ejections:
+            self.probing = False
+            self.ejection_level = 0
+
+    def failed(self, now, epoch, eject=False):
+        """Count a failed request; ``epoch`` is ``ejections`` when it was sent, older requests do not eject again."""
+        self.errors += 1
+        if epoch != self.ejections:
+            return
+        self.failures += 1
+        if eject or self.probing or self.failures >= self.max_failures:
+            delay = min(self.max_ejection_seconds, self.ejection_seconds * 2 ** self.ejection_level)
+            self.ejected_until = now + delay
+            self.ejection_level += 1
+            self.ejections += 1
+            self.failures = 0
+            self.probing = True
+
+    def limited(self, now, headers):
+        self.rate_limited += 1
+        retry_after = headers.get("retry-after")
+        delay = parse_retry_after(retry_after) if retry_after is not None else max(
+            parse_duration(headers.get("x-ratelimit-reset-requests", "")),
+            parse_duration(headers.get("x-ratelimit-reset-tokens", "")), 1.0)
+        self.limited_until = max(self.limited_until, now + delay)
+
+
+class EndpointPool:
+    """
+    Sends each chat request to the endpoint with the best mix of remaining quota and latency.
+
+    Requests that fail on one endpoint with a connection error, a timeout
+    or a server error are retried on the next best one, and the failing
+    endpoint is ejected after repeated failures (see ``Endpoint``). A 429
+    only blocks its endpoint until its quota resets; the request fails
+    with the rate limit error when every endpoint is blocked, so the run's
+    rate limiter backs off. Endpoints are
+    ``{"api_base": ..., "api_key": ..., "model": ...}`` dicts, ``model``
+    defaults to the run's model.
+    """
+
+    def __init__(self, endpoints, model, **options):
+        self.endpoints = [Endpoint(endpoint["api_base"], endpoint.get("api_key"), endpoint.get("model") or model,
+                                   **options) for endpoint in endpoints]
+        self.random = random.Random()
+
+    def pick(self, exclude=()):
+        now = time.monotonic()
+        candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude and endpoint.available(now)]
+        if not candidates:
+            return None
+        latencies = [endpoint.latency for endpoint in self.endpoints if endpoint.latency is not None]
+        default_latency = sum(latencies) / len(latencies) if latencies else 1.0
+        best = max(endpoint.score(default_latency) for endpoint in candidates)
+        return self.random.choice([endpoint for endpoint in candidates if endpoint.score(default_latency) == best])
+
+    async def post(self, path, body):
+        """POST ``body`` (with the endpoint's model) and return the json response and its headers."""
+        import httpx
+        tried = []
+        error = None
+        while True:
+            endpoint = self.pick(exclude=tried)
+            if endpoint is None:
+                break
+            tried.append(endpoint)
+            endpoint.in_flight += 1
+            endpoint.requests += 1
+            epoch = endpoint.ejections
+            sent = time.monotonic()
+            try:
+                response = await endpoint.client().post(path, json={**body, "model": endpoint.model})
+            except httpx.TransportError as e:
+                endpoint.failed(time.monotonic(), epoch)
+                error = EndpointError(f"{endpoint.name}: {type(e).__name__} {e}")
+                continue
+            finally:
+                endpoint.in_flight -= 1
+            endpoint.observe(response.headers)
+            if response.status_code == 429:
+                endpoint.limited(time.monotonic(), response.headers)
+                error = EndpointError(f"{endpoint.name}: {response.text}", 429, response.headers)
+                continue
+            if response.status_code in _RETRY_STATUSES or response.status_code in _KEY_STATUSES:
+                endpoint.failed(time.monotonic(), epoch, eject=response.status_code in _KEY_STATUSES)
+                error = EndpointError(f"{endpoint.name}: {response.status_code} {response.text}",
+                                      response.status_code, response.headers)
+                continue
+            if response.status_code >= 400:
+                raise EndpointError(f"{endpoint.name}: {response.status_code} {response.text}", response.status_code,
+                                    response.headers)
+            endpoint.succeeded(time.monotonic() - sent, epoch)
+            return response.json(), response.headers
+        if error is None:
+            # every endpoint is ejected or blocked by its quota, the rate limiter waits for them
+            error = EndpointError("No endpoint available", 429)
+        raise error
+
+    async def aclose(self):
+        """Close the connections of every endpoint."""
+        for endpoint in self.endpoints:
+            await endpoint.aclose()
+
+    def summary(self):
+        now = time.monotonic()
+        parts = []
+        for endpoint in self.endpoints:
+            state = "ejected" if now < endpoint.ejected_until else "limited" if now < endpoint.limited_until else "ok"
+            latency = f"{endpoint.latency:.2f}s" if endpoint.latency is not None else "-"
+            parts.append(f"{endpoint.name}: {endpoint.requests} requests, {endpoint.errors} errors, "
+                         f"{endpoint.rate_limited} 429s, {endpoint.ejections} ejections, latency {latency}, "
+                         f"quota {endpoint.quota():.0%}, {state}")
+        return "Endpoints: " + " | ".join(parts)
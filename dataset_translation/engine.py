@@ -0,0 +1,219 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import collections
+import time
+from .metrics import censored_quantile, quantile
+from .rate_limit import estimate_tokens, is_rate_limit_error
+
+
+class TranslationEngine:
+    """
+    Runs guidance programs asynchronously from a single process.
+
+    Instead of one OS process per in-flight request (``Dataset.map(num_proc=N)``),
+    all requests share one event loop and at most ``max_concurrency`` of them
+    are in flight at any time. With a ``rate_limiter`` every request first
+    waits for its share of the (shared) request and token budget, and rate
+    limit errors are retried after the limiter's backoff. With a ``cache``
+    finished outputs are persisted immediately and replayed on later runs
+    without touching the API; callers ``forget`` the outputs they reject, so
+    a malformed reply is not replayed. An ``accountant`` records the token usage of
+    every request that is sent, and ``metrics`` its queue wait, latency and
+    outcome.
+
+    Every attempt has a deadline of ``timeout`` seconds, after which it is
+    cancelled and retried like a rate limited one. With a ``hedge_budget``
+    a request still running after the ``hedge_quantile`` of the observed
+    request latencies gets a duplicate, the first answer is used and the
+    other request cancelled. At most ``hedge_budget`` (a share of the sent
+    requests) are duplicated, so hedging costs at most that much more.
+    """
+
+    def __init__(self, program, max_concurrency=256, rate_limiter=None, cache=None, max_retries=8, accountant=None,
+                 metrics=None, timeout=None, hedge_budget=0.0, hedge_quantile=0.95, min_hedge_samples=20,
+                 window=10000):
+        self.program = program
+        self.max_concurrency = max_concurrency
+        self.rate_limiter = rate_limiter
+        self.cache = cache
+        self.max_retries = max_retries
+        self.accountant = accountant
+        self.metrics = metrics
+        self.timeout = timeout
+        self.hedge_budget = hedge_budget
+        self.hedge_quantile = hedge_quantile
+        self.min_hedge_samples = min_hedge_samples
+        # (latency, finished) of every single request, cancelled ones are lower bounds
+        self.request_latencies = collections.deque(maxlen=window)
+        # latency of the attempts as the caller sees them, i.e. with hedging
+        self.call_latencies = collections.deque(maxlen=window)
+        self.sent = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.timeouts = 0
+        self._hedge_delay = None
+        self._semaphore = None
+        self._loop = None
+        self._template_tokens = estimate_tokens(getattr(program, "text", ""))
+
+    def estimate_request_tokens(self, kwargs):
+        input_tokens = sum(estimate_tokens(str(value)) for value in kwargs.values())
+        # the translation is about as long as its input
+        return self._template_tokens + 2 * input_tokens
+
+    async def __call__(self, **kwargs):
+        if self.cache is not None:
+            key = self.cache.key(getattr(self.program, "text", ""), kwargs)
+            output = self.cache.get(key)
+            if output is not None:
+                if self.accountant is not None:
+                    self.accountant.record_cached()
+                if self.metrics is not None:
+                    self.metrics.request("cached")
+                return {"output": output}
+        out = await self._execute(**kwargs)
+        if self.cache is not None and out.get("output") is not None:
+            self.cache.put(key, out["output"])
+        return out
+
+    def forget(self, **kwargs):
+        """Drop the cached output of a request the caller could not use, the next run sends it again."""
+        if self.cache is not None:
+            self.cache.delete(self.cache.key(getattr(self.program, "text", ""), kwargs))
+
+    async def _execute(self, **kwargs):
+        # The semaphore is bound to the running event loop, and every map() starts a new one
+        if self._loop is not asyncio.get_running_loop():
+            self._loop = asyncio.get_running_loop()
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        queued = time.perf_counter()
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                if self.rate_limiter is not None:
+                    await self.rate_limiter.acquire(self.estimate_request_tokens(kwargs))
+                sent = time.perf_counter()
+                try:
+                    out = await asyncio.wait_for(self._send(kwargs), self.timeout)
+                except asyncio.TimeoutError:
+                    self.timeouts += 1
+                    self.call_latencies.append(time.perf_counter() - sent)
+                    self._record("timeout", queued, sent, attempt)
+                    if attempt == self.max_retries:
+                        raise
+                    queued = time.perf_counter()
+                    continue
+                except Exception as e:
+                    rate_limited = is_rate_limit_error(e)
+                    self._record("rate_limited" if rate_limited else type(e).__name__, queued, sent, attempt)
+                    if self.rate_limiter is None or not rate_limited or attempt == self.max_retries:
+                        raise
+                    self.rate_limiter.backoff(e)
+                    queued = time.perf_counter()
+                    continue
+                self.call_latencies.append(time.perf_counter() - sent)
+                self._record("ok", queued, sent, attempt)
+                if self.rate_limiter is not None:
+                    self.rate_limiter.success(out.get("headers"))
+                if self.accountant is not None:
+                    self.accountant.record_request(getattr(self.program, "text", ""), kwargs, out.get("output"))
+                return out
+
+    async def _request(self, kwargs):
+        started = time.perf_counter()
+        try:
+            out = await self.program(async_mode=True, **kwargs)
+        except asyncio.CancelledError:
+            self.request_latencies.append((time.perf_counter() - started, False))
+            raise
+        self.request_latencies.append((time.perf_counter() - started, True))
+        return out
+
+    def hedge_delay(self):
+        """Seconds after which a request gets a duplicate, None until enough latencies were observed."""
+        if not self.hedge_budget or len(self.request_latencies) < self.min_hedge_samples:
+            return None
+        # sorting the whole window for every request would cost more than the hedges save
+        if self._hedge_delay is None or self.sent % 64 == 0:
+            self._hedge_delay, _ = censored_quantile(self.request_latencies, self.hedge_quantile)
+        return self._hedge_delay
+
+    async def _send(self, kwargs):
+        """Send one request, and a duplicate if it is slow; the request still running is cancelled."""
+        self.sent += 1
+        primary = asyncio.ensure_future(self._request(kwargs))
+        tasks = {primary}
+        try:
+            delay = self.hedge_delay()
+            if delay is not None:
+                await asyncio.wait(tasks, timeout=delay)
+                if not primary.done() and self.hedged < self.hedge_budget * self.sent:
+                    if self.rate_limiter is not None:
+                        await self.rate_limiter.acquire(self.estimate_request_tokens(kwargs))
+                    if not primary.done():
+                        self.hedged += 1
+                        tasks.add(asyncio.ensure_future(self._request(kwargs)))
+                        if self.metrics is not None:
+                            self.metrics.request("hedged")
+                        if self.accountant is not None:
+                            # the output of the cancelled request is not known, only its prompt is booked
+                            self.accountant.record_request(getattr(self.program, "text", ""), kwargs, None)
+            while True:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in done if task.exception() is None), None)
+                if winner is not None or not tasks:
+                    break
+            if winner is not None and winner is not primary:
+                self.hedge_wins += 1
+            # both requests failed, the error of the first one is raised
+            return (winner or primary).result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                # wait for the cancelled requests, so their latencies are recorded
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    def latency_summary(self):
+        calls = [quantile(self.call_latencies, q) for q in (0.5, 0.95, 0.99)]
+        single = [censored_quantile(self.request_latencies, q) for q in (0.5, 0.95, 0.99)]
+        text = ("Tail latency with hedging: " + ", ".join(
+                    f"p{round(100 * q)} {value:.2f}s" for q, value in zip((0.5, 0.95, 0.99), calls))
+                + " | without hedging: " + ", ".join(
+                    f"p{round(100 * q)} {'' if exact else '>='}{value:.2f}s"
+                    for q, (value, exact) in zip((0.5, 0.95, 0.99), single))
+                + f" | {self.timeouts} timeouts")
+        if self.hedge_budget:
+            text += (f" | {self.hedged} hedged ({self.hedged / max(1, self.sent):.1%} of {self.sent} requests, "
+                     f"budget {self.hedge_budget:.0%}), {self.hedge_wins} answered by the hedge")
+        return text
+
+    def _record(self, status, queued, sent, attempt):
+        if self.metrics is not None:
+            self.metrics.request(status, queue_wait=sent - queued, latency=time.perf_counter() - sent, attempt=attempt)
+
+    def print_summary(self):
+        if self.rate_limiter is not None:
+            print(self.rate_limiter.summary())
+        if self.cache is not None:
+            print(self.cache.summary())
+        if self.accountant is not None:
+            print(self.accountant.summary())
+        if self.metrics is not None:
+            print(self.metrics.summary())
+        if self.call_latencies:
+            print(self.latency_summary())
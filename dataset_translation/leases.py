@@ -0,0 +1,247 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Row leases for running one translation on several workers without a coordinator.
+"""
+
+import itertools
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+
+def default_worker():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class LeaseTable:
+    """
+    Row ranges of a run claimed by workers through a shared SQLite file.
+
+    Each worker ``claim``\\s the next free range of a key (a split or an
+    MMLU subject), translates it and marks it ``complete``. A lease expires
+    ``lease_seconds`` after it was claimed or last ``renew``\\ed, and the
+    range is then handed to the next worker that asks, so the ranges of
+    crashed workers are picked up again. ``claim(key, whole=True)`` leases
+    a whole key as one range. ``start_renewing`` keeps every lease of the
+    worker alive while its rows are still in flight. The end of a key is
+    either set up front (``set_end``) or found when a range comes back
+    short, e.g. at the end of a streaming split.
+
+    Every worker opens the same file, so it has to be on a filesystem with
+    working locks (a local disk for several processes, or a network share
+    that supports them).
+    """
+
+    def __init__(self, path, run, worker=None, lease_seconds=600, range_size=256):
+        self.path = path
+        self.run = run
+        self.worker = worker or default_worker()
+        self.lease_seconds = lease_seconds
+        self.range_size = range_size
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases ("
+            "run TEXT, key TEXT, start INTEGER, stop INTEGER, worker TEXT, expires REAL, done INTEGER, "
+            "PRIMARY KEY (run, key, start))"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS ends (run TEXT, key TEXT, end INTEGER, PRIMARY KEY (run, key))")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS merges (run TEXT PRIMARY KEY, worker TEXT, merged REAL)")
+        self.claimed = 0
+        self.reclaimed = 0
+        self._stop_renewing = None
+
+    def _transaction(self, update):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = update()
+            self.conn.execute("COMMIT")
+            return result
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def _end(self, key):
+        row = self.conn.execute("SELECT end FROM ends WHERE run = ? AND key = ?", (self.run, key)).fetchone()
+        return row[0] if row is not None else None
+
+    def _set_end(self, key, end):
+        self.conn.execute("INSERT OR IGNORE INTO ends VALUES (?, ?, ?)", (self.run, key, end))
+        self.conn.execute("UPDATE ends SET end = MIN(end, ?) WHERE run = ? AND key = ?", (end, self.run, key))
+
+    def set_end(self, key, end):
+        """No range of ``key`` starts at or after row ``end``."""
+        self._transaction(lambda: self._set_end(key, end))
+
+    def claim(self, key, whole=False):
+        """Lease the next free range of ``key``, returns ``(start, stop)`` (``stop`` None for a whole key) or None."""
+        def update():
+            now = time.time()
+            expired = self.conn.execute(
+                "SELECT start, stop FROM leases WHERE run = ? AND key = ? AND done = 0 AND expires < ? "
+                "ORDER BY start LIMIT 1", (self.run, key, now)
+            ).fetchone()
+            if expired is not None:
+                self.conn.execute("UPDATE leases SET worker = ?, expires = ? WHERE run = ? AND key = ? AND start = ?",
+                                  (self.worker, now + self.lease_seconds, self.run, key, expired[0]))
+                self.reclaimed += 1
+                return expired
+            last = self.conn.execute(
+                "SELECT COUNT(*), COUNT(stop), MAX(stop) FROM leases WHERE run = ? AND key = ?", (self.run, key)
+            ).fetchone()
+            if last[0] > last[1]:
+                # the key was leased as a whole
+                return None
+            start = last[2] or 0
+            end = self._end(key)
+            if (end is not None and start >= end) or (whole and last[0]):
+                return None
+            stop = None if whole else start + self.range_size
+            self.conn.execute("INSERT INTO leases VALUES (?, ?, ?, ?, ?, ?, 0)",
+                              (self.run, key, start, stop, self.worker, now + self.lease_seconds))
+            self.claimed += 1
+            return start, stop
+
+        return self._transaction(update)
+
+    def renew(self, key, start):
+        """Extend a lease of this worker, False if it expired and another worker took the range over."""
+        def update():
+            return self.conn.execute(
+                "UPDATE leases SET expires = ? WHERE run = ? AND key = ? AND start = ? AND worker = ? AND done = 0",
+                (time.time() + self.lease_seconds, self.run, key, start, self.worker)
+            ).rowcount > 0
+        return self._transaction(update)
+
+    def start_renewing(self):
+        """Renew every open lease of this worker each quarter of ``lease_seconds``, until ``stop_renewing``."""
+        stop = self._stop_renewing = threading.Event()
+
+        def renew():
+            # sqlite connections are bound to their thread
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            while not stop.wait(self.lease_seconds / 4):
+                conn.execute("UPDATE leases SET expires = ? WHERE run = ? AND worker = ? AND done = 0",
+                             (time.time() + self.lease_seconds, self.run, self.worker))
+            conn.close()
+
+        threading.Thread(target=renew, daemon=True).start()
+
+    def stop_renewing(self):
+        if self._stop_renewing is not None:
+            self._stop_renewing.set()
+            self._stop_renewing = None
+
+    def complete(self, key, start, rows):
+        """Mark a range as translated, ``rows`` is how many source rows it had; a short range ends the key."""
+        def update():
+            stop = self.conn.execute("SELECT stop FROM leases WHERE run = ? AND key = ? AND start = ?",
+                                     (self.run, key, start)).fetchone()[0]
+            self.conn.execute("UPDATE leases SET done = 1, worker = ? WHERE run = ? AND key = ? AND start = ?",
+                              (self.worker, self.run, key, start))
+            if stop is None or start + rows < stop:
+                self._set_end(key, start + rows)
+        self._transaction(update)
+
+    def _finished(self, keys):
+        for key in keys:
+            end = self._end(key)
+            if end is None:
+                return False
+            pending = self.conn.execute(
+                "SELECT COUNT(*) FROM leases WHERE run = ? AND key = ? AND done = 0 AND start < ?", (self.run, key, end)
+            ).fetchone()[0]
+            if pending:
+                return False
+        return True
+
+    def finished(self, keys):
+        """True once every range of every key is translated."""
+        return self._transaction(lambda: self._finished(keys))
+
+    def claim_merge(self, keys):
+        """True for exactly one worker, the first to ask after every range of ``keys`` was translated."""
+        def update():
+            if not self._finished(keys):
+                return False
+            return self.conn.execute("INSERT OR IGNORE INTO merges VALUES (?, ?, ?)",
+                                     (self.run, self.worker, time.time())).rowcount > 0
+        return self._transaction(update)
+
+    def summary(self):
+        done, total = self.conn.execute("SELECT COALESCE(SUM(done), 0), COUNT(*) FROM leases WHERE run = ?",
+                                        (self.run,)).fetchone()
+        return (f"Leases of {self.worker}: {self.claimed} ranges claimed, {self.reclaimed} taken over from expired "
+                f"leases | {done}/{total} ranges of the run done")
+
+
+class LeasedWriter:
+    """
+    Writer of one leased range that renews the lease while its rows are written.
+
+    A lease is renewed at most every quarter of ``lease_seconds``. If the
+    lease was lost (the worker stalled for longer than ``lease_seconds``),
+    a warning is printed; both copies of the rows are written to the same
+    range files and de-duplicated by the merge.
+    """
+
+    def __init__(self, writer, leases, key, start):
+        self.writer = writer
+        self.leases = leases
+        self.key = key
+        self.start = start
+        self.renewed = time.monotonic()
+
+    def __call__(self, index, row):
+        self.writer(index, row)
+        if time.monotonic() - self.renewed > self.leases.lease_seconds / 4:
+            self.renewed = time.monotonic()
+            if not self.leases.renew(self.key, self.start):
+                print(f"Lease of {self.key} rows {self.start}+ expired, another worker took them over")
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+
+class RangeReader:
+    """
+    Reads row ranges of one split, one pass over the rows for increasing ranges.
+
+    A worker's new claims always lie after its previous ones, so a stream is
+    only read again from the start for a range taken over from an expired
+    lease. ``position`` is the source index of the next row.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.iterator = None
+        self.position = 0
+
+    def read(self, start, stop):
+        if self.iterator is None or start < self.position:
+            self.iterator = iter(self.rows)
+            self.position = 0
+        for _ in itertools.islice(self.iterator, start - self.position):
+            self.position += 1
+        while stop is None or self.position < stop:
+            try:
+                row = next(self.iterator)
+            except StopIteration:
+                return
+            self.position += 1
+            yield row
@@ -0,0 +1,211 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .accounting import usage_labels
+
+_QUANTILES = [0.5, 0.95, 0.99]
+
+
+def quantile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def censored_quantile(samples, q):
+    """
+    Kaplan-Meier quantile of ``(value, observed)`` samples, where ``observed``
+    is False for a lower bound (e.g. a request cancelled before it finished).
+
+    Returns ``(value, exact)``. If the lower bounds hide the quantile, the
+    largest sample is returned with ``exact`` False.
+    """
+    if not samples:
+        return 0.0, True
+    at_risk = len(samples)
+    survival = 1.0
+    # at equal values the finished requests count before the cancelled ones
+    for value, observed in sorted(samples, key=lambda sample: (sample[0], not sample[1])):
+        if observed:
+            survival *= 1 - 1 / at_risk
+            if 1 - survival > q + 1e-9:
+                return value, True
+        at_risk -= 1
+    return max(value for value, _ in samples), False
+
+
+class Metrics:
+    """
+    Per-request instrumentation of a translation run.
+
+    Every request the engine sends is recorded with its queue wait (time
+    spent waiting for a concurrency slot and the rate limiter), API latency,
+    status and attempt, and every parse with its duration and outcome. Each
+    event is appended to ``jsonl_path`` together with the row, split and
+    retry depth labels of the task. Counters and p50/p95/p99 latencies are
+    written in the Prometheus text format to ``prometheus_path`` every
+    ``write_interval`` seconds, so a long run can be watched (or scraped
+    via ``serve()``) while it is going on.
+    """
+
+    def __init__(self, jsonl_path="metrics.jsonl", prometheus_path="metrics.prom", write_interval=10.0, window=10000):
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self.write_interval = write_interval
+        self.started = time.time()
+        self._written = 0.0
+        self._text = ""
+        self._events = open(jsonl_path, "a", encoding="utf-8", buffering=1) if jsonl_path else None
+        self.latencies = collections.deque(maxlen=window)
+        self.queue_waits = collections.deque(maxlen=window)
+        self.parse_times = collections.deque(maxlen=window)
+        self.finished = collections.deque()
+        self.sums = collections.Counter()
+        self.counts = collections.Counter()
+        self.requests = collections.Counter()
+        self.parses = collections.Counter()
+        self.depths = collections.Counter()
+
+    def _emit(self, event):
+        event = {"time": time.time(), **usage_labels.get(), **event}
+        if self._events is not None:
+            self._events.write(json.dumps(event, ensure_ascii=False) + "\n")
+        if event["time"] - self._written >= self.write_interval:
+            self.write_prometheus()
+
+    def request(self, status, queue_wait=None, latency=None, attempt=0):
+        """
+        Record one request attempt; ``status`` is ``ok``, ``cached``, ``timeout``,
+        ``rate_limited`` or the error type, ``hedged`` for the duplicate of a slow request.
+        """
+        self.requests[status] += 1
+        if status == "ok":
+            self.depths[usage_labels.get().get("depth", 0)] += 1
+            self.finished.append(time.time())
+        if queue_wait is not None:
+            self.queue_waits.append(queue_wait)
+            self.sums["queue_wait"] += queue_wait
+            self.counts["queue_wait"] += 1
+        if latency is not None:
+            self.latencies.append(latency)
+            self.sums["latency"] += latency
+            self.counts["latency"] += 1
+        self._emit({"event": "request", "status": status, "queue_wait": queue_wait, "latency": latency,
+                    "attempt": attempt})
+
+    @contextlib.contextmanager
+    def parse(self):
+        """
+        Time a parse: ``with metrics.parse() as result: result["outcome"] = ...``.
+
+        The outcome defaults to ``"ok"`` and is set to the exception type if
+        parsing raises.
+        """
+        result = {"outcome": "ok"}
+        start = time.perf_counter()
+        try:
+            yield result
+        except Exception as e:
+            result["outcome"] = type(e).__name__
+            raise
+        finally:
+            self.observe_parse(time.perf_counter() - start, result["outcome"])
+
+    def observe_parse(self, seconds, outcome):
+        self.parse_times.append(seconds)
+        self.sums["parse"] += seconds
+        self.counts["parse"] += 1
+        self.parses[outcome] += 1
+        self._emit({"event": "parse", "outcome": outcome, "seconds": seconds})
+
+    def throughput(self, window=60.0):
+        now = time.time()
+        while self.finished and self.finished[0] < now - window:
+            self.finished.popleft()
+        return len(self.finished) / min(window, max(now - self.started, 1e-9))
+
+    def prometheus(self):
+        lines = ["# TYPE translation_requests_total counter"]
+        lines += [f'translation_requests_total{{status="{status}"}} {count}' for status, count in sorted(self.requests.items())]
+        lines.append("# TYPE translation_requests_by_depth_total counter")
+        lines += [f'translation_requests_by_depth_total{{depth="{depth}"}} {count}' for depth, count in sorted(self.depths.items())]
+        lines.append("# TYPE translation_parses_total counter")
+        lines += [f'translation_parses_total{{outcome="{outcome}"}} {count}' for outcome, count in sorted(self.parses.items())]
+        for name, values, key in [("translation_request_latency_seconds", self.latencies, "latency"),
+                                  ("translation_queue_wait_seconds", self.queue_waits, "queue_wait"),
+                                  ("translation_parse_seconds", self.parse_times, "parse")]:
+            lines.append(f"# TYPE {name} summary")
+            lines += [f'{name}{{quantile="{q}"}} {quantile(values, q):.6f}' for q in _QUANTILES]
+            lines += [f"{name}_sum {self.sums[key]:.6f}", f"{name}_count {self.counts[key]}"]
+        lines += ["# TYPE translation_requests_per_second gauge",
+                  f"translation_requests_per_second {self.throughput():.3f}"]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self):
+        self._written = time.time()
+        self._text = self.prometheus()
+        if not self.prometheus_path:
+            return
+        # written next to the target and renamed, so a scraper never reads half a file
+        tmp_path = f"{self.prometheus_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self._text)
+        os.replace(tmp_path, self.prometheus_path)
+
+    def serve(self, port=9109):
+        """
+        Serve the Prometheus text on ``http://localhost:port/metrics`` from a background thread.
+
+        The thread only reads the text rendered by the last ``write_prometheus()``,
+        the counters themselves are never touched outside the event loop.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics._text.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def close(self):
+        self.write_prometheus()
+        if self._events is not None:
+            self._events.close()
+            self._events = None
+
+    def summary(self):
+        return (f"Requests: {dict(self.requests)} | latency p50 {quantile(self.latencies, 0.5):.2f}s, "
+                f"p95 {quantile(self.latencies, 0.95):.2f}s, p99 {quantile(self.latencies, 0.99):.2f}s | "
+                f"queue wait p95 {quantile(self.queue_waits, 0.95):.2f}s | "
+                f"parse p95 {1000 * quantile(self.parse_times, 0.95):.2f}ms, outcomes {dict(self.parses)}")
@@ -0,0 +1,265 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import re
+
+# Output schemas of the translation prompts: field name -> expected type
+ARC_FIELDS = {"question": str, "choices": list}
+HELLASWAG_FIELDS = {"activity_label": str, "context": str, "endings": list}
+MMLU_FIELDS = {"question": str, "A": str, "B": str, "C": str, "D": str}
+TRUTHFULQA_FIELDS = {"question": str, "choices": list}
+
+# Keys the model sometimes translates although it is told not to
+TRUTHFULQA_ALIASES = {
+    "question": ["Frage", "frage"],
+    "choices": ["Antworten", "Antwortmöglichkeiten", "Auswahlmöglichkeiten", "Möglichkeiten", "Optionen",
+                "Aussagen", "Auswahlen", "möglichkeiten", "optionen", "aussagen", "auswahlen", "antworten",
+                "antwortmöglichkeiten", "auswahlmöglichkeiten", "Auswahl", "auswahl"],
+}
+
+_WHITESPACE = re.compile(r"[ \t\r\n]*")
+_STRING_SPECIAL = re.compile(r'["\\]')
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class _Truncated(Exception):
+    pass
+
+
+class TruncatedList(list):
+    """A list the output was cut off in, its first items are complete but more may have followed."""
+
+
+class _LenientParser:
+    """
+    Single left-to-right pass over model output that looks like JSON.
+
+    Besides valid JSON it accepts the failure modes seen in the raw
+    translations: missing closing braces/brackets (the value that was cut
+    off is dropped), a list value without its opening ``[``, unescaped
+    quotes and raw newlines inside strings, and trailing text after the
+    object. A list cut off by the end of the output keeps its complete
+    items as a ``TruncatedList``.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.n = len(text)
+
+    def skip(self, pos):
+        return _WHITESPACE.match(self.text, pos).end()
+
+    def parse(self):
+        start = self.text.find("{")
+        if start == -1:
+            # the object may have lost its opening brace as well
+            return self.object(0)[0]
+        return self.object(start + 1)[0]
+
+    def object(self, pos):
+        result = {}
+        while True:
+            pos = self.skip(pos)
+            if pos >= self.n:
+                return result, pos
+            char = self.text[pos]
+            if char == "}":
+                return result, pos + 1
+            if char == ",":
+                pos += 1
+                continue
+            if char != '"':
+                return result, pos
+            try:
+                key, pos = self.string(pos + 1, strict=True)
+            except _Truncated:
+                return result, self.n
+            pos = self.skip(pos)
+            if pos >= self.n or self.text[pos] != ":":
+                return result, pos
+            try:
+                value, pos = self.value(pos + 1)
+            except _Truncated:
+                return result, self.n
+            value, pos = self.continued_list(value, pos)
+            result[key] = value
+
+    def continued_list(self, value, pos):
+        # `"endings": "a", "b", "c"]` -- strings following a value that are not keys belong to a list
+        items = None
+        while True:
+            comma = self.skip(pos)
+            if comma >= self.n or self.text[comma] != ",":
+                break
+            quote = self.skip(comma + 1)
+            if quote >= self.n or self.text[quote] != '"' or self.is_key(quote):
+                break
+            try:
+                item, pos = self.string(quote + 1)
+            except _Truncated:
+                return TruncatedList(items if items is not None else [value]), self.n
+            items = items if items is not None else [value]
+            items.append(item)
+        if items is None:
+            return value, pos
+        end = self.skip(pos)
+        if end >= self.n:
+            return TruncatedList(items), end
+        if self.text[end] == "]":
+            pos = end + 1
+        return items, pos
+
+    def is_key(self, pos):
+        try:
+            _, end = self.string(pos + 1, strict=True)
+        except _Truncated:
+            return False
+        end = self.skip(end)
+        return end < self.n and self.text[end] == ":"
+
+    def value(self, pos):
+        pos = self.skip(pos)
+        if pos >= self.n:
+            raise _Truncated()
+        char = self.text[pos]
+        if char == '"':
+            return self.string(pos + 1)
+        if char == "[":
+            return self.array(pos + 1)
+        if char == "{":
+            value, end = self.object(pos + 1)
+            if end >= self.n and not self.text.rstrip().endswith("}"):
+                raise _Truncated()
+            return value, end
+        return self.literal(pos)
+
+    def array(self, pos):
+        items = []
+        while True:
+            pos = self.skip(pos)
+            if pos >= self.n:
+                if items:
+                    # keep the elements that were complete before the cut
+                    return TruncatedList(items), pos
+                raise _Truncated()
+            char = self.text[pos]
+            if char == "]":
+                return items, pos + 1
+            if char == ",":
+                pos += 1
+                continue
+            if char == "}":
+                # missing closing bracket
+                return items, pos
+            try:
+                item, pos = self.value(pos)
+            except _Truncated:
+                return TruncatedList(items), self.n
+            items.append(item)
+
+    def literal(self, pos):
+        end = pos
+        while end < self.n and self.text[end] not in ",}]\n":
+            end += 1
+        token = self.text[pos:end].strip()
+        try:
+            return json.loads(token), end
+        except ValueError:
+            return token, end
+
+    def string(self, pos, strict=False):
+        chars = []
+        while pos < self.n:
+            match = _STRING_SPECIAL.search(self.text, pos)
+            if match is None:
+                break
+            chars.append(self.text[pos:match.start()])
+            pos = match.start()
+            char = self.text[pos]
+            if char == "\\":
+                if pos + 1 >= self.n:
+                    break
+                escape = self.text[pos + 1]
+                if escape == "u" and pos + 6 <= self.n:
+                    try:
+                        chars.append(chr(int(self.text[pos + 2:pos + 6], 16)))
+                        pos += 6
+                        continue
+                    except ValueError:
+                        pass
+                chars.append(_ESCAPES.get(escape, escape))
+                pos += 2
+                continue
+            if strict or self.closes_string(pos + 1):
+                return "".join(chars), pos + 1
+            chars.append(char)
+            pos += 1
+        raise _Truncated()
+
+    def closes_string(self, pos):
+        # a quote only closes a value if structure follows it, otherwise it is part of the text
+        pos = self.skip(pos)
+        if pos >= self.n or self.text[pos] in "}]:":
+            return True
+        if self.text[pos] == ",":
+            pos = self.skip(pos + 1)
+            return pos >= self.n or self.text[pos] in '"]}'
+        return False
+
+
+def parse_lenient(text):
+    """Parse the first JSON object in ``text``, tolerating truncation and common syntax errors."""
+    try:
+        value = json.loads(text)
+        if isinstance(value, dict):
+            return value
+    except ValueError:
+        pass
+    return _LenientParser(text).parse()
+
+
+def extract_fields(text, fields, aliases=None, partial_lists=False):
+    """
+    Pull the schema ``fields`` out of raw model output in one pass.
+
+    Returns a dict with one entry per field; fields that are missing or have
+    the wrong type are ``None``, so callers can tell which parts of a
+    translation are usable. A list cut off by the end of the output is
+    ``None`` as well, unless ``partial_lists`` is set for a caller that
+    fills in the missing items (it then has fewer items than the source).
+    """
+    aliases = aliases or {}
+    parsed = parse_lenient(text or "")
+    result = {}
+    for field, kind in fields.items():
+        value = None
+        for key in [field] + aliases.get(field, []):
+            if key in parsed:
+                value = parsed[key]
+                break
+        if kind is str and isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = str(value)
+        if kind is list and isinstance(value, TruncatedList) and not partial_lists:
+            value = None
+        if kind is list and isinstance(value, list):
+            value = [str(item) if isinstance(item, (int, float)) else item for item in value]
+            if not all(isinstance(item, str) for item in value):
+                value = None
+        if not isinstance(value, kind):
+            value = None
+        result[field] = value
+    return result
@@ -0,0 +1,192 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Pre-pass that flags the answer options which are copied into the
+translation instead of being sent to the model. Check the classification
+on a sample of MMLU answer options with
+
+    python -m dataset_translation.passthrough
+"""
+
+import re
+import sys
+from .rate_limit import estimate_tokens
+
+# Column written by the pre-pass: one category (or "") per answer option
+PASSTHROUGH_COLUMN = "_passthrough"
+
+_ELEMENTS = set(
+    "H He Li Be B C N O F Ne Na Mg Al Si P S Cl Ar K Ca Sc Ti V Cr Mn Fe Co Ni Cu Zn Ga Ge As Se Br Kr Rb Sr Y Zr "
+    "Nb Mo Tc Ru Rh Pd Ag Cd In Sn Sb Te I Xe Cs Ba La Ce Pr Nd Pm Sm Eu Gd Tb Dy Ho Er Tm Yb Lu Hf Ta W Re Os Ir "
+    "Pt Au Hg Tl Pb Bi Po At Rn Fr Ra Ac Th Pa U Np Pu Am Cm Bk Cf Es Fm Md No Lr".split()
+)
+_UNITS = ("m|cm|mm|km|nm|s|ms|g|kg|mg|N|J|kJ|W|kW|V|A|Hz|K|mol|eV|Pa|kPa|atm|L|mL|°C|°F|°|%|m/s|m/s\\^?2|"
+          "km/h|J/mol|kJ/mol|g/mol|M|Ω|rad")
+_MATH_WORDS = {"sin", "cos", "tan", "log", "ln", "exp", "sqrt", "lim", "max", "min", "mod", "gcd", "lcm", "det"}
+
+_NUMERIC = re.compile(r"[-+−~≈<>≤≥$€£]?\s*[\d.,]+(?:\s*(?:x|×|\*)\s*10\^?[-−]?\d+|e[-+]?\d+)?(?:\s*(?:" + _UNITS + r"))?"
+                      r"(?:\s*(?:,|-|–|/|:)\s*[-+−]?[\d.,]+(?:\s*(?:" + _UNITS + r"))?)*")
+_LATEX = re.compile(r"\$[^$]+\$|\\\(.+?\\\)|\\\[.+?\\\]")
+_LATEX_COMMAND = re.compile(r"\\[a-zA-Z]+")
+_MATH = re.compile(r"[\w\s+\-−*/^=<>≤≥≠≈()\[\]{}.,|!'√π∞∑∫∂±·×÷%_]+")
+# brackets alone are no operator, "(A)" is an option label
+_MATH_OPERATOR = re.compile(r"[\d+\-−*/^=<>≤≥≠≈√π∞∑∫∂±·×÷|_!]|[A-Za-z]\(")
+_LETTERS = re.compile(r"[A-Za-z]+")
+# a keyword alone ("if", "int") is an English word, it needs an operand to be code
+_CODE = re.compile(r"[;{}]|==|!=|\+\+|&&|\|\||->|:=|\w\[[^\]]*\]|\w\([^)]*\)|"
+                   r"^\s*(?:def|return|print|int|for|while|if)\s+\S")
+_SENTENCE = re.compile(r"[A-Za-z]{2,}\s+[A-Za-z]{2,}")
+_FORMULA = re.compile(r"(?:[A-Z][a-z]?\d*|\((?:[A-Z][a-z]?\d*)+\)\d*|\[(?:[A-Z][a-z]?\d*)+\]\d*|\^?\d*[+\-−]|\s*(?:→|->|⇌|<->|=|\+|·)\s*|\d+)+")
+_FORMULA_TOKEN = re.compile(r"[A-Z][a-z]?")
+_FORMULA_MARKER = re.compile(r"[\d+\-−=·^()\[\]→⇌$\\]")
+_SYMBOL = re.compile(r"\s*\S\s*|\s*[^\sA-Za-z]{1,3}\s*")
+_ROMAN = re.compile(r"(?=[IVX])X{0,3}(?:IX|IV|V?I{0,3})")
+_ITEM = rf"(?:\d+(?:\.\d+)?|{_ROMAN.pattern})"
+_ENUMERATION = re.compile(rf"{_ITEM}(?:\s*,\s*{_ITEM})*\s*,?\s+(and|or|&)\s+{_ITEM}")
+_CONJUNCTIONS = {"and": "und", "or": "oder", "&": "&"}
+# everything that is not prose, in RE2 syntax for the vectorized pass
+_NOT_PROSE = r"[\d$\\;{}+\-−*/^=<>≤≥≠≈()\[\]√π∞∑∫∂±·×÷|_!→⇌]|\b[IVX]+\b"
+
+
+def _is_math(text):
+    stripped = _LATEX_COMMAND.sub(" ", _LATEX.sub(" ", text))
+    if stripped != text and not any(len(word) > 1 for word in _LETTERS.findall(stripped)):
+        return True
+    if not _MATH.fullmatch(text) or not _MATH_OPERATOR.search(text):
+        return False
+    # single letter variables and function names only, any longer word is natural language
+    return all(len(word) == 1 or word.lower() in _MATH_WORDS for word in _LETTERS.findall(text))
+
+
+def _is_code(text):
+    return bool(_CODE.search(text)) and not _SENTENCE.search(text)
+
+
+def _is_formula(text):
+    if not _FORMULA.fullmatch(text.strip()):
+        return False
+    tokens = _FORMULA_TOKEN.findall(text)
+    if not tokens or not all(token in _ELEMENTS for token in tokens):
+        return False
+    # "He", "NO" or "OK" are words, a formula has a count, a charge, a bond, a reaction arrow
+    # or several symbols in mixed case, e.g. "NaCl"
+    return bool(_FORMULA_MARKER.search(text)) or (len(tokens) > 1 and text != text.upper())
+
+
+def classify(text):
+    """Return why ``text`` can be copied into the translation unchanged, or ``""`` if it has to be translated."""
+    text = text.strip()
+    if not text or _SYMBOL.fullmatch(text):
+        return "symbol"
+    if _NUMERIC.fullmatch(text) or _ROMAN.fullmatch(text):
+        return "numeric"
+    if _ENUMERATION.fullmatch(text):
+        return "enumeration"
+    if _is_formula(text):
+        return "formula"
+    if _is_math(text):
+        return "math"
+    if _is_code(text):
+        return "code"
+    return ""
+
+
+def copy_segment(text, category):
+    """The translation of a flagged segment: ``text`` itself, an enumeration with German conjunctions."""
+    if category == "enumeration":
+        return _ENUMERATION.sub(lambda match: match.group(0).replace(
+            match.group(1), _CONJUNCTIONS[match.group(1)]), text.strip())
+    return text
+
+
+def classify_batch(batch, column="choices"):
+    """
+    Batched ``Dataset.map`` function that adds one category per entry of ``column``.
+
+    Prose is found for the whole batch in one vectorized pass, only the
+    other entries are classified one by one.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    texts = pa.array(batch[column], pa.list_(pa.string()))
+    flat = pc.list_flatten(texts)
+    prose = pc.and_kleene(pc.match_substring_regex(flat, _SENTENCE.pattern),
+                          pc.invert(pc.match_substring_regex(flat, _NOT_PROSE)))
+    categories = iter("" if is_prose else classify(text)
+                      for text, is_prose in zip(flat.to_pylist(), pc.fill_null(prose, False).to_pylist()))
+    return {PASSTHROUGH_COLUMN: [[next(categories) for _ in range(length)]
+                                 for length in pc.fill_null(pc.list_value_length(texts), 0).to_pylist()]}
+
+
+def mark_passthrough(dataset, column="choices"):
+    """Classify every entry of ``column`` in one batched pass over the dataset."""
+    return dataset.map(classify_batch, batched=True, batch_size=1000, fn_kwargs={"column": column})
+
+
+def passthrough_stats(dataset, column="choices"):
+    """Fraction of the segments and estimated tokens in ``column`` that the pre-pass removed from the prompts."""
+    segments = removed = tokens = removed_tokens = 0
+    categories = {}
+    for texts, flags in zip(dataset[column], dataset[PASSTHROUGH_COLUMN]):
+        for text, flag in zip(texts, flags):
+            text_tokens = estimate_tokens(text)
+            segments += 1
+            tokens += text_tokens
+            if flag:
+                removed += 1
+                removed_tokens += text_tokens
+                categories[flag] = categories.get(flag, 0) + 1
+    return {
+        "segments": segments,
+        "removed": removed,
+        "removed_fraction": removed / segments if segments else 0.0,
+        "tokens": tokens,
+        "removed_tokens": removed_tokens,
+        "removed_tokens_fraction": removed_tokens / tokens if tokens else 0.0,
+        "categories": categories,
+    }
+
+
+# answer options of the MMLU test set and the category they must get
+MMLU_SAMPLE = {
+    "0": "symbol", "-3": "symbol", "%": "symbol", "6.02 x 10^23": "numeric", "25.5%": "numeric",
+    "9.8 m/s^2": "numeric", "$10,000": "numeric", "1, 2 and 3": "enumeration", "II": "numeric", "IV": "numeric",
+    "I and II": "enumeration", "I, II, and III": "enumeration", "2 or 3": "enumeration",
+    "NaCl": "formula", "NaOH": "formula", "HCl": "formula", "H2O": "formula", "CH3COOH": "formula",
+    "2H2 + O2 → 2H2O": "formula", "SO4^2-": "formula",
+    "x^2 + 1": "math", "f(x) = 2x": "math", "\\frac{1}{2}": "math", "$\\sqrt{2}$": "math", "a + b": "math",
+    "x = x + 1;": "code", "print(x)": "code", "return 0": "code", "a[i] = b[i];": "code",
+    "int": "", "if": "", "(A)": "", "I only": "", "II and III only": "", "True, True": "", "False, False": "",
+    "OK": "", "NO": "", "UK": "", "CO": "", "He": "", "None of the above": "", "All of the above": "",
+    "Wrong, Not wrong": "", "The cell membrane": "", "Increase in entropy": "", "Both A and B": "",
+}
+
+
+def check(sample=None):
+    """Classify ``sample`` (default: ``MMLU_SAMPLE``), print every mismatch and return their number."""
+    sample = MMLU_SAMPLE if sample is None else sample
+    texts = list(sample)
+    categories = classify_batch({"choices": [texts]})[PASSTHROUGH_COLUMN][0]
+    mismatches = 0
+    for text, category in zip(texts, categories):
+        if category != sample[text]:
+            mismatches += 1
+            print(f"{text!r}: {category or 'translate'}, expected {sample[text] or 'translate'}")
+    print(f"{len(texts) - mismatches}/{len(texts)} options classified as expected")
+    return mismatches
+
+
+if __name__ == "__main__":
+    sys.exit(1 if check() else 0)
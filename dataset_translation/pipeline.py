@@ -0,0 +1,262 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import heapq
+import itertools
+from tqdm import tqdm
+from .accounting import label
+
+
+class LengthAwareQueue:
+    """
+    Rows waiting to be translated, longest first, released under a token budget.
+
+    ``pop()`` returns the most expensive waiting row as long as it fits into
+    ``max_tokens_in_flight`` next to the rows already running. If it does
+    not fit, the largest smaller row that does is started instead, so the
+    budget stays packed. The head is passed over at most ``max_passes``
+    times before nothing else may start ahead of it. Lower ``priority``
+    values always go first.
+    """
+
+    def __init__(self, max_tokens_in_flight=None, max_passes=64):
+        self.max_tokens_in_flight = max_tokens_in_flight
+        self.max_passes = max_passes
+        self.tokens_in_flight = 0
+        self.heap = []
+        self.counter = itertools.count()
+        self.passes = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, item, tokens=0, priority=0):
+        heapq.heappush(self.heap, (priority, -tokens, next(self.counter), tokens, item))
+
+    def fits(self, tokens):
+        return (self.max_tokens_in_flight is None or not self.tokens_in_flight
+                or self.tokens_in_flight + tokens <= self.max_tokens_in_flight)
+
+    def pop(self):
+        """Return ``(item, tokens)`` of the next row to start, or ``None`` if none may start now."""
+        if not self.heap:
+            return None
+        if self.fits(self.heap[0][3]):
+            self.passes = 0
+            return self._take(0)
+        if self.passes >= self.max_passes:
+            return None
+        head_priority = self.heap[0][0]
+        candidates = [i for i, entry in enumerate(self.heap) if entry[0] == head_priority and self.fits(entry[3])]
+        if not candidates:
+            return None
+        self.passes += 1
+        return self._take(max(candidates, key=lambda i: (self.heap[i][3], -self.heap[i][2])))
+
+    def _take(self, i):
+        entry = self.heap[i]
+        if i == 0:
+            heapq.heappop(self.heap)
+        else:
+            self.heap[i] = self.heap[-1]
+            self.heap.pop()
+            heapq.heapify(self.heap)
+        self.tokens_in_flight += entry[3]
+        return entry[4], entry[3]
+
+    def release(self, tokens):
+        self.tokens_in_flight -= tokens
+
+
+async def translate_stream(rows, function, max_in_flight=512, skip=(), cost=None, lookahead=1,
+                           max_tokens_in_flight=None, start=0):
+    """
+    Yield ``(index, translated_row)`` pairs as soon as each row is done.
+
+    Rows are pulled lazily from ``rows`` (any iterable, e.g. a streaming
+    dataset) and at most ``max_in_flight`` of them are being translated at
+    once, so there are no shard barriers and memory stays flat. Source
+    indices in ``skip`` are not translated again. With ``cost(row)`` (the
+    estimated tokens of a row) up to ``lookahead`` rows are read ahead and
+    the longest start first, and the rows in flight are kept within
+    ``max_tokens_in_flight``, so long rows do not end up in the tail of
+    the run. Indices count from ``start``, the source index of the first row.
+    """
+    rows = enumerate(rows, start)
+    queue = LengthAwareQueue(max_tokens_in_flight)
+    in_flight = {}
+
+    def read():
+        while len(queue) < max(1, lookahead):
+            try:
+                index, row = next(rows)
+            except StopIteration:
+                return
+            if index in skip:
+                continue
+            queue.push((index, row), cost(row) if cost is not None else 0)
+
+    def fill():
+        read()
+        while len(in_flight) < max_in_flight:
+            popped = queue.pop()
+            if popped is None:
+                return
+            (index, row), tokens = popped
+            # the task copies the labels, so its token usage is booked on this row
+            label(row=index)
+            in_flight[asyncio.ensure_future(function(row))] = (index, tokens)
+            read()
+
+    fill()
+    while in_flight:
+        done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            index, tokens = in_flight.pop(task)
+            queue.release(tokens)
+            yield index, task.result()
+        fill()
+
+
+def run_pipeline(rows, function, writer, validate=None, review_queue=None, max_in_flight=512, desc=None,
+                 total=None, cost=None, lookahead=1, max_tokens_in_flight=None, start=0):
+    """
+    Read, translate, validate and write ``rows`` continuously.
+
+    ``writer`` is called with ``(index, row)`` for every finished row; rows
+    in its ``done`` checkpoint are skipped. Rows that need a human look are
+    handed to ``review_queue`` instead of blocking the pipeline. ``cost``,
+    ``lookahead`` and ``max_tokens_in_flight`` schedule the longest rows
+    first, see ``translate_stream``. ``start`` is the source index of the
+    first row, e.g. of a leased range. Returns row and invalid counts.
+    """
+    stats = {"rows": 0, "invalid": 0}
+
+    async def run():
+        with tqdm(total=total, desc=desc) as pbar:
+            async for index, row in translate_stream(rows, function, max_in_flight, writer.done, cost, lookahead,
+                                                     max_tokens_in_flight, start):
+                if validate is not None and not validate(row):
+                    stats["invalid"] += 1
+                if review_queue is not None:
+                    review_queue.collect(index, row)
+                writer(index, row)
+                stats["rows"] += 1
+                pbar.update(1)
+
+    try:
+        asyncio.run(run())
+    finally:
+        writer.close()
+    return stats
+
+
+class Job:
+    """
+    One source of rows for ``run_pool``, e.g. one MMLU subject.
+
+    ``load`` is only called once the pool needs the job's rows, so sources
+    are loaded lazily. Lower ``priority`` values are scheduled first.
+    ``on_done(job)`` runs after the last row of the job was written and its
+    writer was closed.
+    """
+
+    def __init__(self, name, load, writer, priority=0, on_done=None):
+        self.name = name
+        self.load = load
+        self.writer = writer
+        self.priority = priority
+        self.on_done = on_done
+        self.rows = 0
+        self.invalid = 0
+
+
+def run_pool(jobs, function, validate=None, max_in_flight=512, desc=None, cost=None, lookahead=1,
+             max_tokens_in_flight=None):
+    """
+    Translate the rows of many jobs through one global priority queue.
+
+    Rows of all jobs share ``max_in_flight`` slots; the next job is loaded
+    only when its rows are needed to fill a free slot (or to keep
+    ``lookahead`` rows queued), one job at a time between dispatches, so
+    requests start after the first load and a job's slowest rows never
+    hold up the following ones. Within a priority the longest rows (by ``cost``)
+    start first under ``max_tokens_in_flight``, see ``translate_stream``.
+    Each job keeps its own writer. Returns per-job row and invalid counts.
+    """
+    pending = sorted(jobs, key=lambda job: job.priority)
+    queue = LengthAwareQueue(max_tokens_in_flight)
+    outstanding = {}
+
+    def load_next():
+        job = pending.pop(0)
+        outstanding[job.name] = 0
+        for index, row in enumerate(job.load()):
+            if index not in job.writer.done:
+                queue.push((job, index, row), cost(row) if cost is not None else 0, job.priority)
+                outstanding[job.name] += 1
+        if not outstanding[job.name]:
+            finish(job)
+
+    def finish(job):
+        job.writer.close()
+        del outstanding[job.name]
+        if job.on_done is not None:
+            job.on_done(job)
+
+    async def run():
+        in_flight = {}
+        with tqdm(desc=desc) as pbar:
+            while True:
+                loading = bool(pending) and (len(queue) < lookahead or len(in_flight) + len(queue) < max_in_flight)
+                if loading:
+                    load_next()
+                while len(in_flight) < max_in_flight:
+                    popped = queue.pop()
+                    if popped is None:
+                        break
+                    (job, index, row), tokens = popped
+                    label(split=job.name, row=index)
+                    in_flight[asyncio.ensure_future(function(row))] = (job, index, tokens)
+                if not in_flight:
+                    if pending:
+                        continue
+                    break
+                # while more jobs are to be loaded, only let the new requests start before loading the next one
+                done, _ = await asyncio.wait(in_flight, timeout=0 if loading else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    job, index, tokens = in_flight.pop(task)
+                    queue.release(tokens)
+                    row = task.result()
+                    if validate is not None and not validate(row):
+                        job.invalid += 1
+                    job.writer(index, row)
+                    job.rows += 1
+                    outstanding[job.name] -= 1
+                    pbar.update(1)
+                    if not outstanding[job.name]:
+                        finish(job)
+
+    try:
+        asyncio.run(run())
+    finally:
+        # keep the checkpoints of jobs that were interrupted
+        for job in jobs:
+            if job.name in outstanding:
+                job.writer.close()
+    return {job.name: {"rows": job.rows, "invalid": job.invalid} for job in jobs}
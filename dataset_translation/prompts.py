@@ -0,0 +1,107 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import ast
+import functools
+import re
+
+_ROLE_BLOCK = re.compile(r"{{#(system|user|assistant)~?}}(.*?){{~?/\1}}", re.DOTALL)
+_IF_BLOCK = re.compile(r"{{#if (\w+)}}(.*?){{/if}}", re.DOTALL)
+_GEN = re.compile(r"{{gen\b(?:\"(?:\\.|[^\"])*\"|'[^']*'|[^}\"'])*}}")
+_VARIABLE = re.compile(r"{{~?(\w+)~?}}")
+_GEN_OPTION = re.compile(r"(\w+)=(\"(?:\\.|[^\"])*\"|'[^']*'|[^\s}]+)")
+
+
+# what guidance's {{gen}} uses for options the template leaves out
+GEN_DEFAULTS = {"temperature": 0.0, "top_p": 1.0, "max_tokens": 500}
+
+
+class ChatPrompt:
+    """
+    A guidance chat template compiled once into the messages it sends.
+
+    Supports the subset of the template syntax used by the translation
+    programs: role blocks, ``{{variable}}``, ``{{#if variable}}...{{/if}}``
+    and a final ``{{gen ...}}``. Compilation stops at the block that
+    generates, so ``render(inputs)`` returns the prompt of the request by
+    joining precompiled pieces, without parsing the template again.
+    ``options`` are the keyword arguments of the ``{{gen ...}}`` call.
+    """
+
+    def __init__(self, template):
+        self.template = template
+        self.options = generation_options(template)
+        # [(role, [(condition, variable, text)])], a piece is skipped if its condition input is empty
+        self.messages = []
+        for role, content in _ROLE_BLOCK.findall(template):
+            if _GEN.search(content):
+                break
+            pieces = []
+            position = 0
+            for match in _IF_BLOCK.finditer(content):
+                pieces += self._compile(content[position:match.start()])
+                pieces += self._compile(match.group(2), condition=match.group(1))
+                position = match.end()
+            pieces += self._compile(content[position:])
+            self.messages.append((role, pieces))
+
+    @staticmethod
+    def _compile(text, condition=None):
+        pieces = []
+        position = 0
+        for match in _VARIABLE.finditer(text):
+            pieces.append((condition, None, text[position:match.start()]))
+            pieces.append((condition, match.group(1), None))
+            position = match.end()
+        pieces.append((condition, None, text[position:]))
+        return [piece for piece in pieces if piece[1] is not None or piece[2]]
+
+    def render(self, inputs):
+        messages = []
+        for role, pieces in self.messages:
+            content = "".join(
+                text if variable is None else str(inputs.get(variable, ""))
+                for condition, variable, text in pieces
+                if condition is None or inputs.get(condition)
+            )
+            messages.append({"role": role, "content": content.strip()})
+        return messages
+
+
+@functools.lru_cache(maxsize=None)
+def compile_template(template):
+    return ChatPrompt(template)
+
+
+def render_messages(template, inputs):
+    """Render a guidance chat template into the messages that are sent to the model, see ``ChatPrompt``."""
+    return compile_template(template).render(inputs)
+
+
+def generation_options(template):
+    """Return the keyword arguments of the template's ``{{gen ...}}`` call, e.g. temperature, stop and max_tokens."""
+    match = _GEN.search(template)
+    if match is None:
+        return {}
+    options = {}
+    for key, value in _GEN_OPTION.findall(match.group(0)):
+        # quoted strings, numbers and True/False as in python, bare words are template variables
+        try:
+            options[key] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            raise ValueError(f"Unsupported value {value} of the {key} option in {match.group(0)}, "
+                             f"only quoted strings, numbers and True/False are supported") from None
+    return options
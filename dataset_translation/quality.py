@@ -0,0 +1,148 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Quality report of the translated outputs, computed column by column with
+pyarrow.compute instead of one Python ``filter`` pass per check.
+"""
+
+import json
+import re
+
+# function words that do not occur in German, two or more of them mean the text is still English
+_ENGLISH = r"\b(?:the|and|which|with|of|is|are|were|this|that|from|for)\b"
+# only text of three or more words must change, names, numbers and formulas may stay as they are
+_SENTENCE = r"[A-Za-z]{2,}\W+[A-Za-z]{2,}\W+[A-Za-z]{2,}"
+_KEY = r'"(?:[^"\\]|\\.)*"\s*:'
+
+
+def _column(table, path):
+    import pyarrow.compute as pc
+    name, *fields = path.split(".")
+    column = table[name]
+    column = column.combine_chunks()
+    for field in fields:
+        column = pc.struct_field(column, field)
+    return column
+
+
+def _is_list(column):
+    import pyarrow as pa
+    return pa.types.is_list(column.type) or pa.types.is_large_list(column.type)
+
+
+def _rows(mask):
+    """Positions where ``mask`` is true, nulls count as false."""
+    import pyarrow.compute as pc
+    return pc.indices_nonzero(pc.fill_null(mask, False))
+
+
+def _rows_with(list_column, element_mask):
+    """Positions of the rows with at least one list element where ``element_mask`` is true."""
+    import pyarrow.compute as pc
+    parents = pc.list_parent_indices(list_column)
+    return pc.unique(pc.filter(parents, pc.fill_null(element_mask, False)))
+
+
+def _text(column, separator=" "):
+    """Strings as they are, lists of strings joined into one string per row."""
+    import pyarrow.compute as pc
+    return pc.binary_join(column, separator) if _is_list(column) else column
+
+
+def quality_report(table, columns, index_column, raw_column=None, fields=(), aliases=None, blank=None,
+                   min_ratio=0.5, max_ratio=2.5, min_length=20):
+    """
+    Check every translated row of ``table`` in one vectorized pass per column.
+
+    ``columns`` maps source to target columns (dotted for struct fields,
+    e.g. ``{"choices.text": "choices_de.text"}``), strings or lists of
+    strings. Rows are reported by their ``index_column`` value for
+
+        empty             a missing, empty or null target (or list entry)
+        choice_count      a target list with another length than the source
+        length_ratio      target/source length outside ``[min_ratio, max_ratio]``
+                          for sources of at least ``min_length`` characters
+        blanks            a different number of ``blank`` markers (e.g. "_________")
+        untranslated      a target identical to its source, or still English
+        unknown_keys      keys in ``raw_column`` that are not in ``fields`` or ``aliases``
+
+    Returns ``{"rows": n, "checks": {check: {"count": ..., "rows": [...]}}, "requeue": [...]}``
+    where ``requeue`` lists every row that failed any check.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    n = table.num_rows
+    index = table[index_column].combine_chunks()
+    failed = {check: [] for check in ["empty", "choice_count", "length_ratio", "blanks", "untranslated", "unknown_keys"]}
+
+    for source_path, target_path in columns.items():
+        source = _column(table, source_path)
+        target = _column(table, target_path)
+        if _is_list(target):
+            elements = pc.list_flatten(target)
+            failed["empty"] += [
+                _rows(pc.or_kleene(pc.is_null(target), pc.equal(pc.list_value_length(target), 0))),
+                _rows_with(target, pc.or_kleene(pc.is_null(elements), pc.equal(pc.utf8_length(elements), 0))),
+            ]
+            same_length = pc.fill_null(pc.equal(pc.list_value_length(source), pc.list_value_length(target)), False)
+            failed["choice_count"].append(_rows(pc.invert(same_length)))
+            # entries are compared pairwise where both lists have the same length
+            positions = pc.indices_nonzero(same_length)
+            source_elements = pc.list_flatten(pc.filter(source, same_length))
+            target_elements = pc.list_flatten(pc.filter(target, same_length))
+            unchanged = pc.and_kleene(pc.equal(source_elements, target_elements),
+                                      pc.match_substring_regex(source_elements, _SENTENCE))
+            failed["untranslated"].append(pc.take(positions, _rows_with(pc.filter(target, same_length), unchanged)))
+        else:
+            failed["empty"].append(_rows(pc.or_kleene(pc.is_null(target), pc.equal(pc.utf8_length(target), 0))))
+            failed["untranslated"].append(_rows(pc.and_kleene(pc.equal(source, target),
+                                                              pc.match_substring_regex(source, _SENTENCE))))
+
+        source_text, target_text = _text(source), _text(target)
+        source_length = pc.utf8_length(source_text)
+        ratio = pc.divide(pc.cast(pc.utf8_length(target_text), pa.float64()), pc.cast(source_length, pa.float64()))
+        outlier = pc.or_kleene(pc.less(ratio, min_ratio), pc.greater(ratio, max_ratio))
+        failed["length_ratio"].append(_rows(pc.and_kleene(pc.greater_equal(source_length, min_length), outlier)))
+        english = pc.count_substring_regex(target_text, _ENGLISH, ignore_case=True)
+        failed["untranslated"].append(_rows(pc.greater_equal(english, 2)))
+        if blank is not None:
+            failed["blanks"].append(_rows(pc.not_equal(pc.count_substring(source_text, blank),
+                                                       pc.count_substring(target_text, blank))))
+
+    if raw_column is not None and fields:
+        keys = list(fields) + [alias for names in (aliases or {}).values() for alias in names]
+        raw = table[raw_column].combine_chunks()
+        known = rf'"(?:{"|".join(re.escape(key) for key in keys)})"\s*:'
+        extra = pc.subtract(pc.count_substring_regex(raw, _KEY), pc.count_substring_regex(raw, known))
+        failed["unknown_keys"].append(_rows(pc.greater(extra, 0)))
+
+    checks = {}
+    requeue = set()
+    for check, parts in failed.items():
+        positions = pa.concat_arrays([part.cast(pa.int64()) for part in parts]) if parts else pa.array([], pa.int64())
+        rows = sorted(set(index.take(positions).to_pylist()))
+        checks[check] = {"count": len(rows), "rows": rows}
+        requeue.update(rows)
+    return {"rows": n, "checks": checks, "requeue": sorted(requeue)}
+
+
+def format_report(name, report):
+    counts = ", ".join(f"{check} {result['count']}" for check, result in report["checks"].items())
+    return f"Quality of {name}: {len(report['requeue'])}/{report['rows']} rows to re-queue | {counts}"
+
+
+def save_report(report, path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
@@ -0,0 +1,199 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import asyncio
+import email.utils
+import random
+import re
+import sqlite3
+import statistics
+import time
+from collections import deque
+
+
+def estimate_tokens(text):
+    # ~4 characters per token for English text
+    return max(1, len(text) // 4)
+
+
+def parse_duration(value):
+    """Parse OpenAI reset durations such as ``"1s"``, ``"6m0s"`` or ``"20ms"`` into seconds."""
+    seconds = 0.0
+    for amount, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value):
+        seconds += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return seconds
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a ``Retry-After`` header, given in seconds or as an HTTP date."""
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def is_rate_limit_error(error):
+    return getattr(error, "http_status", None) == 429 or type(error).__name__ == "RateLimitError"
+
+
+class RateLimiter:
+    """
+    Token bucket limiting requests and tokens per minute.
+
+    The bucket state lives in a SQLite file, so every process (and every
+    script) pointing at the same file draws from one shared budget.
+    Rate limit errors put the whole bucket into an exponential backoff with
+    full jitter, and the ``x-ratelimit-*`` headers of every response (passed
+    to ``success`` and ``backoff``) tighten the local estimate of the
+    remaining quota, so requests are paced before the API starts refusing
+    them.
+    """
+
+    def __init__(self, name, requests_per_min, tokens_per_min, path="rate_limits.sqlite",
+                 max_backoff=60.0):
+        self.name = name
+        self.requests_per_min = requests_per_min
+        self.tokens_per_min = tokens_per_min
+        self.max_backoff = max_backoff
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            "name TEXT PRIMARY KEY, requests REAL, tokens REAL, updated REAL, "
+            "rpm REAL, tpm REAL, blocked_until REAL, backoff_level INTEGER)"
+        )
+        self.conn.execute(
+            "INSERT OR IGNORE INTO buckets VALUES (?, ?, ?, ?, ?, ?, 0, 0)",
+            (name, requests_per_min, tokens_per_min, time.time(), requests_per_min, tokens_per_min),
+        )
+        self.conn.execute("UPDATE buckets SET rpm = ?, tpm = ? WHERE name = ?",
+                          (requests_per_min, tokens_per_min, name))
+        self.queue_times = []
+        self.granted = deque()
+        self.rate_limited = 0
+
+    def _transaction(self, update):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.conn.execute(
+                "SELECT requests, tokens, updated, rpm, tpm, blocked_until, backoff_level "
+                "FROM buckets WHERE name = ?", (self.name,)
+            ).fetchone()
+            result = update(*row)
+            self.conn.execute("COMMIT")
+            return result
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def _try_acquire(self, tokens):
+        def update(requests, available, updated, rpm, tpm, blocked_until, level):
+            now = time.time()
+            if blocked_until > now:
+                return blocked_until - now
+            elapsed = now - updated
+            requests = min(rpm, requests + elapsed * rpm / 60)
+            available = min(tpm, available + elapsed * tpm / 60)
+            # a single request larger than the bucket only has to wait for a full bucket
+            needed = min(tokens, tpm)
+            if requests >= 1 and available >= needed:
+                requests, available, wait = requests - 1, available - needed, 0.0
+            else:
+                wait = max((1 - requests) * 60 / rpm, (needed - available) * 60 / tpm)
+            self.conn.execute("UPDATE buckets SET requests = ?, tokens = ?, updated = ? WHERE name = ?",
+                              (requests, available, now, self.name))
+            return wait
+        return self._transaction(update)
+
+    async def acquire(self, tokens):
+        """Wait until one request of ``tokens`` tokens fits into the shared budget."""
+        start = time.monotonic()
+        while True:
+            wait = self._try_acquire(tokens)
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        queued = time.monotonic() - start
+        self.queue_times.append(queued)
+        self.granted.append((time.time(), tokens))
+        return queued
+
+    def backoff(self, error=None):
+        """Block the shared bucket after a rate limit error, growing the delay on repeated errors."""
+        headers = getattr(error, "headers", None) or {}
+        retry_after = headers.get("retry-after")
+        self.rate_limited += 1
+
+        def update(requests, available, updated, rpm, tpm, blocked_until, level):
+            delay = random.uniform(0, min(self.max_backoff, 2 ** level))
+            if retry_after is not None:
+                delay = max(delay, parse_retry_after(retry_after))
+            self.conn.execute("UPDATE buckets SET blocked_until = ?, backoff_level = ? WHERE name = ?",
+                              (max(blocked_until, time.time() + delay), level + 1, self.name))
+        self._transaction(update)
+        self.observe_headers(headers)
+
+    def success(self, headers=None):
+        """Step the backoff down after a successful request, ``headers`` are the ones of its response."""
+        def update(requests, available, updated, rpm, tpm, blocked_until, level):
+            if level > 0:
+                self.conn.execute("UPDATE buckets SET backoff_level = ? WHERE name = ?",
+                                  (level - 1, self.name))
+        self._transaction(update)
+        self.observe_headers(headers)
+
+    def observe_headers(self, headers):
+        """Clamp the bucket to the quota the API reports as remaining."""
+        if not headers or "x-ratelimit-remaining-requests" not in headers:
+            return
+        remaining_requests = float(headers["x-ratelimit-remaining-requests"])
+        remaining_tokens = float(headers.get("x-ratelimit-remaining-tokens", self.tokens_per_min))
+        reset = max(parse_duration(headers.get("x-ratelimit-reset-requests", "")),
+                    parse_duration(headers.get("x-ratelimit-reset-tokens", "")))
+
+        def update(requests, available, updated, rpm, tpm, blocked_until, level):
+            self.conn.execute(
+                "UPDATE buckets SET requests = ?, tokens = ?, blocked_until = ? WHERE name = ?",
+                (min(requests, remaining_requests), min(available, remaining_tokens),
+                 max(blocked_until, time.time() + reset) if remaining_requests < 1 else blocked_until,
+                 self.name),
+            )
+        self._transaction(update)
+
+    def stats(self):
+        now = time.time()
+        while self.granted and self.granted[0][0] < now - 60:
+            self.granted.popleft()
+        waits = sorted(self.queue_times) or [0.0]
+        return {
+            "request_utilization": len(self.granted) / self.requests_per_min,
+            "token_utilization": sum(tokens for _, tokens in self.granted) / self.tokens_per_min,
+            "queue_wait_mean": statistics.mean(waits),
+            "queue_wait_p95": waits[int(0.95 * (len(waits) - 1))],
+            "queue_wait_max": waits[-1],
+            "rate_limited": self.rate_limited,
+        }
+
+    def summary(self):
+        s = self.stats()
+        return (f"Rate limit usage (last min): {s['request_utilization']:.0%} requests, "
+                f"{s['token_utilization']:.0%} tokens | queue wait mean {s['queue_wait_mean']:.2f}s, "
+                f"p95 {s['queue_wait_p95']:.2f}s, max {s['queue_wait_max']:.2f}s | "
+                f"429s: {s['rate_limited']}")
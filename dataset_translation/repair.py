@@ -0,0 +1,125 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+from .parsing import extract_fields
+
+# Columns with the per-row retry bookkeeping
+RETRY_COLUMNS = ["retries_de", "retry_tokens_de"]
+
+repair_template = '''
+{{#system~}}
+You are a helpful assistant that translates json from English to German.
+{{~/system}}
+
+{{#user~}}
+Parts of a json were already translated to German:
+{{done}}
+
+Translate the remaining parts in the following json to german so that they are coherent with the translation above.
+Be as precise as possible. Keep the exact json format and do not translate the keys.
+
+{{input}}
+{{~/user}}
+
+{{#assistant~}}
+{{gen 'output' temperature=0.5 top_p=1}}
+{{~/assistant}}
+'''
+
+
+def is_complete(source, translated):
+    for field, value in source.items():
+        done = translated.get(field)
+        if done is None:
+            return False
+        if isinstance(value, list) and (len(done) != len(value) or any(item is None for item in done)):
+            return False
+    return True
+
+
+def parse_outcome(source, translated):
+    """``"complete"``, ``"partial"`` or ``"failed"``, for the parse metrics."""
+    if is_complete(source, translated):
+        return "complete"
+    return "partial" if any(value is not None for value in translated.values()) else "failed"
+
+
+def missing_segments(source, translated):
+    """Flat ``{segment: English text}`` for every field or list item that has no usable translation."""
+    segments = {}
+    for field, value in source.items():
+        done = translated.get(field)
+        if not isinstance(value, list):
+            if done is None:
+                segments[field] = value
+            continue
+        if done is None or len(done) > len(value):
+            done = []
+        for i, item in enumerate(value):
+            if i >= len(done) or done[i] is None:
+                segments[f"{field}_{i}"] = item
+    return segments
+
+
+def apply_segments(source, translated, segments):
+    translated = dict(translated)
+    for field, value in source.items():
+        if not isinstance(value, list):
+            if translated.get(field) is None and segments.get(field) is not None:
+                translated[field] = segments[field]
+            continue
+        done = translated.get(field)
+        if done is None or len(done) > len(value):
+            done = []
+        done = list(done) + [None] * (len(value) - len(done))
+        for i in range(len(value)):
+            if done[i] is None:
+                done[i] = segments.get(f"{field}_{i}")
+        translated[field] = done
+    return translated
+
+
+async def repair_translation(engine, source, translated, max_attempts=2):
+    """
+    Re-request only the parts of ``source`` that are missing in ``translated``.
+
+    ``source`` and ``translated`` map the prompt's json keys to strings or
+    lists of strings. The parts that did parse are passed along so the new
+    segments stay coherent with them. Returns the repaired translation, the
+    number of repair requests and their estimated tokens.
+    """
+    retries, tokens = 0, 0
+    for attempt in range(max_attempts):
+        segments = missing_segments(source, translated)
+        if not segments:
+            break
+        done = {field: [item for item in value if item is not None] if isinstance(value, list) else value
+                for field, value in translated.items() if value is not None}
+        inputs = {"done": json.dumps(done, ensure_ascii=False), "input": json.dumps(segments)}
+        if attempt > 0:
+            inputs["cache_seed"] = attempt
+        retries += 1
+        tokens += engine.estimate_request_tokens(inputs)
+        try:
+            out = await engine(**inputs)
+        except Exception:
+            continue
+        repaired = extract_fields(out.get("output", ""), {segment: str for segment in segments})
+        if any(value is None for value in repaired.values()):
+            engine.forget(**inputs)
+        translated = apply_segments(source, translated, repaired)
+    return translated, retries, tokens
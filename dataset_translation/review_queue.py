@@ -0,0 +1,200 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Non-interactive review of translations that could not be parsed.
+
+During translation failed outputs are appended to a review queue file and
+the pipeline keeps going. Afterwards a human works through the queue and
+the fixes are written back into the translated outputs:
+
+    python -m dataset_translation.review_queue review outputs_truthfulqa_de/validation.review.jsonl
+    python -m dataset_translation.review_queue apply outputs_truthfulqa_de/validation.review.jsonl outputs_truthfulqa_de validation
+"""
+
+import argparse
+import json
+import os
+from pathlib import Path
+from .parsing import extract_fields
+
+# Rows carry their pending review items in this field until the pipeline hands them to the queue
+REVIEW_COLUMN = "_review"
+
+_TYPES = {"str": str, "list": list}
+
+
+def review_item(key, raw, source, fields, columns, raw_column):
+    """
+    Describe a failed translation so that a fix can be applied without the translation script.
+
+    ``fields`` maps the prompt's json keys to ``"str"``/``"list"``, ``columns``
+    maps the same keys to (dotted) output columns, and ``raw_column`` is
+    where the corrected json is recorded (a column or a list of columns). A list field can also be spread
+    over several columns with ``{column: [positions in the list]}``.
+    """
+    return {"key": key, "raw": raw, "source": source, "fields": fields, "columns": columns,
+            "raw_column": raw_column}
+
+
+def add_review_item(row, item):
+    row.setdefault(REVIEW_COLUMN, []).append(item)
+
+
+def _set_column(row, column, value):
+    *parents, name = column.split(".")
+    for parent in parents:
+        row = row[parent]
+    row[name] = value
+
+
+class ReviewQueue:
+    """Append-only JSON lines file of failed rows, with the human fixes kept next to it."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.fixes_path = self.path.with_suffix(".fixes.jsonl")
+
+    def collect(self, index, row):
+        items = row.pop(REVIEW_COLUMN, None)
+        if not items:
+            return
+        with open(self.path, "a", encoding="utf-8") as f:
+            for item in items:
+                f.write(json.dumps({"id": f"{index}:{item['key']}", "index": index, **item}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _read(self, path):
+        entries = {}
+        if path.exists():
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    entry = json.loads(line)
+                    entries[entry["id"]] = entry
+        return entries
+
+    def entries(self):
+        return self._read(self.path)
+
+    def fixes(self):
+        return {id: entry["fix"] for id, entry in self._read(self.fixes_path).items()}
+
+    def add_fix(self, id, fix):
+        with open(self.fixes_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"id": id, "fix": fix}, ensure_ascii=False) + "\n")
+
+    def pending(self):
+        fixes = self.fixes()
+        return [entry for id, entry in self.entries().items() if id not in fixes]
+
+
+def review(queue):
+    pending = queue.pending()
+    print(f"{len(pending)} translations to review. Enter the corrected json, an empty line skips.")
+    for i, entry in enumerate(pending):
+        print(f"\n[{i + 1}/{len(pending)}] {entry['id']}")
+        print(json.dumps(entry["source"], ensure_ascii=False))
+        print(entry["raw"])
+        while True:
+            fix = input("Corrected json: ").strip()
+            if not fix:
+                break
+            try:
+                json.loads(fix)
+            except ValueError:
+                print("Invalid json, please try again")
+                continue
+            queue.add_fix(entry["id"], fix)
+            break
+
+
+def _apply_fix(row, entry, fix):
+    fields = {field: _TYPES[kind] for field, kind in entry["fields"].items()}
+    translated = extract_fields(fix, fields)
+    for field, column in entry["columns"].items():
+        value = translated[field]
+        if value is None:
+            continue
+        if not isinstance(column, dict):
+            _set_column(row, column, value)
+            continue
+        for name, positions in column.items():
+            if all(position < len(value) for position in positions):
+                _set_column(row, name, [value[position] for position in positions])
+    raw_columns = entry["raw_column"]
+    for column in [raw_columns] if isinstance(raw_columns, str) else raw_columns:
+        _set_column(row, column, fix)
+
+
+def apply(queue, output_dir, split, format="jsonl"):
+    """
+    Write every reviewed fix into the translated rows of ``split``. Returns the number of rows changed.
+
+    The rows of a leased run are spread over range files, each fix goes to
+    the range that holds its row.
+    """
+    from .writer import split_writers
+    entries = queue.entries()
+    fixes = queue.fixes()
+    applied = set()
+    for writer in split_writers(output_dir, split, format=format):
+        rows = writer.latest_rows()
+        changed = set()
+        for id, fix in fixes.items():
+            entry = entries[id]
+            if entry["index"] in rows:
+                _apply_fix(rows[entry["index"]], entry, fix)
+                changed.add(entry["index"])
+                applied.add(id)
+        # appended rows supersede the earlier versions in merge()
+        for index in sorted(changed):
+            writer(index, rows[index])
+        writer.close()
+    missing = len(fixes) - len(applied)
+    if missing:
+        print(f"{missing} fixes are for rows that are not in the outputs of {split}")
+    return len({entries[id]["index"] for id in applied})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Review failed translations and apply the fixes.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    review_parser = subparsers.add_parser("review", help="interactively fix the queued translations")
+    review_parser.add_argument("queue")
+    apply_parser = subparsers.add_parser("apply", help="write the fixes into the translated outputs")
+    apply_parser.add_argument("queue")
+    apply_parser.add_argument("output_dir")
+    apply_parser.add_argument("split")
+    apply_parser.add_argument("--format", default="jsonl", choices=["jsonl", "parquet"])
+    apply_parser.add_argument("--push-to-hub", default=None, help="push the fixed split to this hub dataset")
+    args = parser.parse_args()
+
+    queue = ReviewQueue(args.queue)
+    if args.command == "review":
+        review(queue)
+        return
+    changed = apply(queue, args.output_dir, args.split, args.format)
+    print(f"Applied fixes to {changed} rows")
+    if args.push_to_hub:
+        from .writer import combine_tables, split_writers, to_dataset
+        from .repair import RETRY_COLUMNS
+        dataset = to_dataset(combine_tables([writer.table()
+                                             for writer in split_writers(args.output_dir, args.split, args.format)]))
+        dataset = dataset.remove_columns([column for column in RETRY_COLUMNS if column in dataset.column_names])
+        dataset.push_to_hub(args.push_to_hub, split=args.split)
+
+
+if __name__ == "__main__":
+    main()
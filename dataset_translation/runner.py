@@ -0,0 +1,385 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import functools
+import json
+from pathlib import Path
+from . import settings
+from .accounting import estimate_run, format_estimate, label
+from .batching import AdaptiveBatcher
+from .leases import LeaseTable, LeasedWriter, RangeReader
+from .parsing import extract_fields
+from .passthrough import mark_passthrough, passthrough_stats, copy_segment, PASSTHROUGH_COLUMN
+from .pipeline import run_pipeline, run_pool, Job
+from .prompts import generation_options
+from .quality import quality_report, format_report, save_report
+from .repair import repair_translation, is_complete, parse_outcome, RETRY_COLUMNS
+from .review_queue import ReviewQueue, review_item, add_review_item
+from .runtime import TranslationRun
+from .writer import AppendOnlyWriter, combine_tables, split_writers, to_dataset, INDEX_COLUMN
+
+
+def _count_strings(value):
+    if isinstance(value, list):
+        return sum(_count_strings(item) for item in value)
+    if isinstance(value, dict):
+        return sum(_count_strings(item) for item in value.values())
+    return 1 if isinstance(value, str) else 0
+
+
+def passthrough_segments(spec, example):
+    """The source segments the pre-pass flagged, copied into the translation (enumerations with German conjunctions)."""
+    if spec.passthrough_column is None:
+        return {}
+    source = spec.source(example)
+    flags = example.get(PASSTHROUGH_COLUMN) or []
+    return {field: copy_segment(source[field], flag) for field, flag in zip(spec.passthrough_fields, flags) if flag}
+
+
+def set_raw(spec, example, raw):
+    for column in [spec.raw_column, *spec.raw_copies]:
+        example[column] = raw
+
+
+async def translate_row(run, spec, example, depth=0):
+    """Translate one row with one request, repairing, retrying or queueing it for review as the spec says."""
+    ex = spec.source(example)
+    label(depth=depth)
+    # numbers, formulas and code flagged by the pre-pass are copied, not sent
+    passthrough = passthrough_segments(spec, example)
+    for field in passthrough:
+        del ex[field]
+    known = dict(passthrough)
+    for field in [field for field in spec.memory_fields if field in ex]:
+        target = run.memory.lookup(ex[field])
+        if target is not None:
+            known[field] = target
+            del ex[field]
+    fields = {field: kind for field, kind in spec.fields.items() if field in ex}
+
+    if depth == 0:
+        example["retries_de"] = 0
+        example["retry_tokens_de"] = 0
+        if spec.source_strings is not None:
+            run.stats["strings"] += spec.source_strings(example)
+            run.stats["unique"] += _count_strings(ex)
+
+    inputs = spec.inputs(ex)
+    # a retry is a request of its own, not the cached output of the previous one
+    request = {**inputs, "cache_seed": depth} if depth > 0 else inputs
+    try:
+        if depth > 0:
+            example["retries_de"] += 1
+            example["retry_tokens_de"] += run.engine.estimate_request_tokens(inputs)
+        out = await run.engine(**request)
+    except Exception:
+        spec.target(example, {field: None for field in spec.fields})
+        set_raw(spec, example, "")
+        return example
+    raw = out.get("output") or ""
+    with run.metrics.parse() as parse:
+        # the repair requests the items missing from a cut off list, without it the list is unusable
+        translated = extract_fields(raw, fields, spec.aliases, partial_lists=spec.repair)
+        parse["outcome"] = parse_outcome(ex, translated)
+    if not is_complete(ex, translated):
+        run.engine.forget(**request)
+
+    if spec.review_columns is not None and all(value is None for value in translated.values()):
+        # queue the row for review_queue.py instead of blocking the pipeline on input()
+        add_review_item(example, review_item(
+            key="targets",
+            raw=raw,
+            source=ex,
+            fields={field: kind.__name__ for field, kind in fields.items()},
+            columns=spec.review_columns(example, ex),
+            raw_column=[spec.raw_column, *spec.raw_copies] if spec.raw_copies else spec.raw_column
+        ))
+    elif spec.repair and any(value is not None for value in translated.values()) and not is_complete(ex, translated):
+        translated, retries, tokens = await repair_translation(run.repair_engine, ex, translated)
+        example["retries_de"] += retries
+        example["retry_tokens_de"] += tokens
+
+    complete = is_complete(ex, translated)
+    if not complete and depth < spec.max_depth:
+        return await translate_row(run, spec, example, depth=depth+1)
+    if complete or spec.keep_partial:
+        run.memory.add_segments(ex, translated, spec.name)
+        spec.target(example, {**translated, **known})
+    else:
+        spec.target(example, {field: None for field in spec.fields})
+    # generation stops before the stop sequence, so it is missing from the output
+    stop = generation_options(spec.template).get("stop")
+    set_raw(spec, example, raw + stop if complete and stop else raw)
+    return example
+
+
+async def translate_batched(run, spec, batcher, example):
+    """Translate one row as part of a batched request, falling back to ``translate_row``."""
+    example["retries_de"] = 0
+    example["retry_tokens_de"] = 0
+    segments = spec.source(example)
+    known = passthrough_segments(spec, example)
+    for field in known:
+        del segments[field]
+    for field, text in segments.items():
+        target = run.memory.lookup(text)
+        if target is not None:
+            known[field] = target
+    item = {field: text for field, text in segments.items() if field not in known}
+    try:
+        result = await batcher.submit(item) if item else ({}, None)
+    except Exception:
+        result = None
+    if result is None:
+        # the batches could not be parsed, fall back to one request for this row
+        label(depth=1)
+        return await translate_row(run, spec, example)
+    translated, raw = result
+    run.memory.add_segments(item, translated, spec.name)
+    translated = {**translated, **known}
+    spec.target(example, translated)
+    # the row's own object of the batch response, a row with every segment known had no request
+    set_raw(spec, example, raw if raw is not None else json.dumps(translated, ensure_ascii=False))
+    return example
+
+
+def is_valid_item(item, translated):
+    return is_complete(item, translated) and all(isinstance(translated[field], type(text)) for field, text in item.items())
+
+
+def glossary(run, spec, items):
+    # near-duplicate hints for the main text of each row, the first field of the spec
+    main_field = next(iter(spec.fields))
+    hints = {}
+    for item in items:
+        if main_field in item:
+            for source, target in run.memory.hints(item[main_field], limit=2):
+                hints[source] = target
+    return {"glossary": "\n".join(f"{json.dumps(source)} -> {json.dumps(target, ensure_ascii=False)}"
+                                  for source, target in hints.items())}
+
+
+def load_rows(spec, split, config=None, estimate=False):
+    """
+    Load (or stream) one split and apply the row limits and the pre-pass.
+
+    The cost estimate reads every row, so it is printed for the dry run
+    (``estimate``) and for datasets in memory, but a streamed split is not
+    downloaded twice for it.
+    """
+    from datasets import load_dataset
+    name = config or split
+    rows = load_dataset(spec.path, config or spec.config, split=split, streaming=spec.streaming)
+    limit = spec.limits.get(split)
+    if settings.MAX_ROWS is not None:
+        limit = settings.MAX_ROWS if limit is None else min(limit, settings.MAX_ROWS)
+    if spec.sample_seed is not None:
+        rows = rows.shuffle(seed=spec.sample_seed)
+    if limit is not None:
+        rows = rows.take(limit) if spec.streaming else rows.select(range(min(limit, len(rows))))
+    if spec.passthrough_column is not None:
+        rows = mark_passthrough(rows, spec.passthrough_column)
+        if not spec.streaming:
+            stats = passthrough_stats(rows, spec.passthrough_column)
+            print(f"{name} pre-pass: {stats['removed']}/{stats['segments']} segments ({stats['removed_fraction']:.0%}) "
+                  f"and {stats['removed_tokens_fraction']:.0%} of their tokens copied unchanged {stats['categories']}")
+    if estimate or not spec.streaming:
+        # one request per row, an upper bound when several rows are batched into one request
+        print(format_estimate(name, estimate_run(rows, spec.request_inputs, spec.template, spec.model_name,
+                                                 max_depth=spec.max_depth)))
+    return rows
+
+
+def report(spec, table, name, path):
+    """Run the quality checks over the written ``table``, print a summary and save the report to ``path``."""
+    if not spec.quality_columns or not table.num_rows:
+        return
+    result = quality_report(table, spec.quality_columns, INDEX_COLUMN, raw_column=spec.raw_column,
+                            fields=spec.fields, aliases=spec.aliases, blank=spec.blank)
+    save_report(result, path)
+    print(f"{format_report(name, result)}, row ids in {path}")
+
+
+def run_spec(spec, dry_run=False):
+    """Translate the dataset described by ``spec`` end to end: load, translate, write, merge, push and report."""
+    if dry_run:
+        for config in spec.configs or [None]:
+            for split in spec.splits:
+                load_rows(spec, split, config, estimate=True)
+        return
+
+    run = TranslationRun(spec.name, spec.model_name, spec.template, requests_per_min=spec.requests_per_min,
+                         tokens_per_min=spec.tokens_per_min, max_concurrency=spec.max_concurrency, repair=spec.repair,
+                         request_timeout=spec.request_timeout)
+    translate = functools.partial(translate_row, run, spec)
+    batcher = None
+    if spec.batch_template is not None:
+        extra_inputs = functools.partial(glossary, run, spec) if "glossary" in spec.batch_template else None
+        batcher = AdaptiveBatcher(run.engine_for(spec.batch_template), is_valid_item,
+                                  lambda item: run.engine.estimate_request_tokens(spec.inputs(item)),
+                                  extra_inputs=extra_inputs)
+        translate = functools.partial(translate_batched, run, spec, batcher)
+
+    def request_tokens(example):
+        return run.engine.estimate_request_tokens(spec.request_inputs(example))
+
+    leases = None
+    if settings.LEASES is not None:
+        # several workers share the run, each one translates the row ranges it claims
+        leases = LeaseTable(settings.LEASES, spec.name + settings.state_suffix(), settings.WORKER,
+                            range_size=settings.LEASE_ROWS)
+    # a mock or local run keeps its checkpoints next to the real ones, e.g. outputs_arc_challenge_de.mock
+    output_dir = Path(spec.output_dir + settings.state_suffix())
+    output_dir.mkdir(exist_ok=True)
+    if leases is not None:
+        # leases are otherwise only renewed when a row of their range is written
+        leases.start_renewing()
+    try:
+        if spec.configs is not None:
+            run_configs(spec, run, translate, request_tokens, output_dir, leases)
+        else:
+            run_splits(spec, run, translate, request_tokens, output_dir, leases)
+    finally:
+        if leases is not None:
+            leases.stop_renewing()
+    run.finish(output_dir / ("usage.json" if leases is None else f"usage.{leases.worker}.json"))
+    if run.stats:
+        print(f"Sent {run.stats['unique']} unique strings for {run.stats['strings']} source strings")
+    if batcher is not None:
+        print(batcher.summary())
+    if leases is not None:
+        print(leases.summary())
+    if spec.configs is not None:
+        return
+    if leases is None or leases.claim_merge(spec.splits):
+        publish(spec, output_dir)
+    else:
+        print("No rows left to claim, the last worker to finish merges the outputs")
+
+
+def run_splits(spec, run, translate, request_tokens, output_dir, leases=None):
+    def translate_rows(rows, writer, split, desc, total, start=0):
+        return run_pipeline(rows, translate, writer, validate=spec.is_translated, review_queue=review_queues.get(split),
+                            max_in_flight=spec.max_in_flight, desc=desc, total=total, cost=request_tokens,
+                            lookahead=2048, max_tokens_in_flight=run.max_tokens_in_flight, start=start)
+
+    review_queues = {}
+    for split in spec.splits:
+        rows = load_rows(spec, split)
+        if spec.review_columns is not None:
+            name = split if leases is None else f"{split}.{leases.worker}"
+            review_queues[split] = ReviewQueue(output_dir / f"{name}.review.jsonl")
+        label(split=split)
+        if leases is None:
+            stats = translate_rows(rows, AppendOnlyWriter(output_dir, split, format=spec.output_format), split,
+                                   f"Translating {split}", None if spec.streaming else len(rows))
+            print(f"Translated {stats['rows']} {split} rows, {stats['invalid']} not fully translated")
+            continue
+
+        if not spec.streaming:
+            leases.set_end(split, len(rows))
+        reader = RangeReader(rows)
+        claimed = leases.claim(split)
+        while claimed is not None:
+            start, stop = claimed
+            # every range has its own checkpointed writer, so a range taken over from a crashed worker resumes
+            writer = LeasedWriter(AppendOnlyWriter(output_dir / "ranges", f"{split}-{start:08d}",
+                                                   format=spec.output_format), leases, split, start)
+            stats = translate_rows(reader.read(start, stop), writer, split, f"Translating {split} {start}-{stop}",
+                                   stop - start, start)
+            leases.complete(split, start, max(0, reader.position - start))
+            print(f"Translated {stats['rows']} {split} rows from {start}, {stats['invalid']} not fully translated")
+            claimed = leases.claim(split)
+    for review_queue in review_queues.values():
+        pending = len(review_queue.pending())
+        if pending:
+            print(f"{pending} translations need a manual fix, "
+                  f"run: python -m dataset_translation.review_queue review {review_queue.path}")
+
+
+def split_table(spec, output_dir, split):
+    """Everything written for ``split``, combined from the leased ranges of all workers if there are any."""
+    writers = split_writers(output_dir, split, format=spec.output_format)
+    if len(writers) == 1:
+        return writers[0].table()
+    return combine_tables([writer.table() for writer in writers])
+
+
+def publish(spec, output_dir):
+    from datasets import DatasetDict
+    # Combine splits, the writers already hold every translated row on disk
+    tables = {split: split_table(spec, output_dir, split) for split in spec.splits}
+    dataset = DatasetDict({split: to_dataset(table) for split, table in tables.items()})
+    # the retry bookkeeping stays in the local outputs only
+    if spec.hub_repo is not None and settings.PUSH_TO_HUB:
+        # a split without rows has no columns to push
+        pushed = DatasetDict({split: part.remove_columns(RETRY_COLUMNS)
+                              for split, part in dataset.items() if len(part)})
+        if not pushed:
+            print(f"Nothing translated, {spec.hub_repo} is not pushed")
+        # a single split is pushed as a plain dataset, as it always was
+        elif len(spec.splits) == 1:
+            pushed[spec.splits[0]].push_to_hub(spec.hub_repo)
+        else:
+            pushed.push_to_hub(spec.hub_repo)
+    for split, table in tables.items():
+        report(spec, table, split, output_dir / f"{split}.quality.json")
+
+
+def run_configs(spec, run, translate, request_tokens, output_dir, leases=None):
+    def save(job):
+        table = job.writer.table()
+        report(spec, table, job.name, output_dir / f"{job.name}.quality.json")
+        part = job.writer.merge(table)
+        if PASSTHROUGH_COLUMN in part.column_names:
+            part = part.remove_columns([PASSTHROUGH_COLUMN])
+        total = len(part)
+        part = part.filter(spec.is_translated)
+        print(f"{job.name}: {len(part)}/{total} rows translated")
+        part.to_parquet(str(output_dir / f"{job.name}.parquet"))
+
+    # with leases every config is claimed as a whole, configs held by other workers are skipped
+    claimed = {}
+
+    def load(job):
+        if leases is not None:
+            if leases.claim(job.name, whole=True) is None:
+                return []
+            # another worker may have written to the checkpoint since the writer was opened
+            job.writer = writer(job.name)
+        rows = load_rows(spec, split, job.name)
+        claimed[job.name] = len(rows)
+        return rows
+
+    def finish(job):
+        if leases is None:
+            save(job)
+        elif job.name in claimed:
+            save(job)
+            leases.complete(job.name, 0, claimed[job.name])
+
+    def writer(config):
+        writer = AppendOnlyWriter(output_dir / "parts", config, format=spec.output_format, flush_every=32)
+        return writer if leases is None else LeasedWriter(writer, leases, config, 0)
+
+    # All configs share one work pool, a config is loaded only when its rows are needed to fill free slots.
+    # Finished rows are checkpointed in <output_dir>/parts
+    split = spec.splits[0]
+    jobs = [Job(config, None, writer(config), priority=i, on_done=finish) for i, config in enumerate(spec.configs)]
+    for job in jobs:
+        job.load = functools.partial(load, job)
+    run_pool(jobs, translate, validate=spec.is_translated, max_in_flight=spec.max_in_flight,
+             desc=f"Translating {spec.name}", cost=request_tokens, max_tokens_in_flight=run.max_tokens_in_flight)
@@ -0,0 +1,91 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import collections
+from . import settings
+from .accounting import Accountant
+from .backends import load_program, backend_model, client_summaries, close_clients
+from .cache import TranslationCache
+from .engine import TranslationEngine
+from .metrics import Metrics
+from .rate_limit import RateLimiter
+from .repair import repair_template
+from .translation_memory import TranslationMemory
+
+
+class TranslationRun:
+    """
+    Everything a translation script shares between its requests.
+
+    Nothing is set up on import: the model client, the programs, the caches
+    and the metrics files are only created when a run is constructed, and
+    the openai client only if it is the configured backend. ``name`` names
+    the metrics files (``metrics_<name>.jsonl`` and ``.prom``).
+    """
+
+    def __init__(self, name, model_name, template, requests_per_min, tokens_per_min, max_concurrency=256,
+                 repair=False, request_timeout=None):
+        self.name = name
+        self.model_name = model_name
+        self.max_concurrency = max_concurrency
+        # a stalled request is cancelled and retried instead of holding up the end of the run
+        self.request_timeout = settings.REQUEST_TIMEOUT or request_timeout
+        if settings.BACKEND == "openai":
+            import guidance
+            # set the default language model used to execute guidance programs
+            guidance.llm = guidance.llms.OpenAI(model_name, max_calls_per_min=requests_per_min,
+                                                api_key=settings.API_KEY)
+        # a pool of api keys has the quota of all of them
+        keys = len(settings.BACKEND_OPTIONS.get("endpoints") or [None]) if settings.BACKEND == "direct" else 1
+        requests_per_min, tokens_per_min = keys * requests_per_min, keys * tokens_per_min
+        # the rate limit budget is shared by every process using the same rate_limits.sqlite,
+        # a local model has no API limits
+        self.rate_limiter = RateLimiter(model_name, requests_per_min=requests_per_min, tokens_per_min=tokens_per_min,
+                                        path=settings.state_path("rate_limits.sqlite")
+                                        ) if settings.BACKEND != "local" else None
+        # finished outputs are cached on disk, so a rerun only sends what is missing
+        self.cache = TranslationCache(backend_model(model_name), backend=settings.BACKEND,
+                                      path=settings.state_path("translation_cache.sqlite"))
+        # queue wait, latency and parse times of every request, watch the .prom file while the run is going on
+        self.metrics = Metrics(f"metrics_{name}.jsonl", f"metrics_{name}.prom")
+        # books the real token usage per row, split and retry depth
+        self.accountant = Accountant(model_name)
+        # finished segments are shared between the scripts through the translation memory
+        self.memory = TranslationMemory(settings.state_path("translation_memory.sqlite"))
+        self.engine = self.engine_for(template)
+        # re-requests only the fields that could not be parsed instead of the whole example
+        self.repair_engine = self.engine_for(repair_template) if repair else None
+        # requests take about 15s, so a quarter of the per-minute token budget in flight keeps the limiter busy
+        # without queueing more than it can grant
+        self.max_tokens_in_flight = tokens_per_min // 4 if self.rate_limiter is not None else None
+        # run-wide counters of the row functions, e.g. source vs. sent strings
+        self.stats = collections.Counter()
+
+    def engine_for(self, template):
+        return TranslationEngine(load_program(template, model_name=self.model_name),
+                                 max_concurrency=self.max_concurrency, rate_limiter=self.rate_limiter, cache=self.cache,
+                                 accountant=self.accountant, metrics=self.metrics, timeout=self.request_timeout,
+                                 hedge_budget=settings.HEDGE_BUDGET)
+
+    def finish(self, usage_path):
+        """Print the run summaries, flush the metrics and save the token usage to ``usage_path``."""
+        self.engine.print_summary()
+        for summary in client_summaries():
+            print(summary)
+        close_clients()
+        self.metrics.close()
+        print(self.memory.summary())
+        self.accountant.save(usage_path)
@@ -0,0 +1,67 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Run settings shared by the translation scripts, read from the environment
+so that a run can be changed without editing the scripts:
+
+    TRANSLATION_BACKEND=mock        model backend, see backends.py
+    TRANSLATION_BACKEND_OPTIONS=... json options for the backend
+    TRANSLATION_MAX_ROWS=50         translate at most this many rows per split
+    TRANSLATION_PUSH_TO_HUB=0       keep the outputs local
+    TRANSLATION_LEASES=leases.sqlite
+                                    share the run with other workers through this lease file,
+                                    see leases.py
+    TRANSLATION_WORKER=gpu-box-1    name of this worker (default: host name and process id)
+    TRANSLATION_LEASE_ROWS=256      rows per leased range
+    TRANSLATION_REQUEST_TIMEOUT=60  seconds before a request is cancelled and retried
+                                    (default: the dataset's ``request_timeout``)
+    TRANSLATION_HEDGE_BUDGET=0.05   duplicate requests slower than the observed p95 latency,
+                                    at most this share of the requests (default: 0, off)
+    OPENAI_API_KEY=sk-...           api key of the openai and direct backends, read from
+                                    ./openai_key.txt if unset
+
+The command line options of ``python -m dataset_translation`` override them.
+"""
+
+import json
+import os
+
+BACKEND = os.environ.get("TRANSLATION_BACKEND", "openai")
+BACKEND_OPTIONS = json.loads(os.environ.get("TRANSLATION_BACKEND_OPTIONS") or "{}")
+MAX_ROWS = int(os.environ["TRANSLATION_MAX_ROWS"]) if os.environ.get("TRANSLATION_MAX_ROWS") else None
+PUSH_TO_HUB = os.environ.get("TRANSLATION_PUSH_TO_HUB", "1") != "0"
+API_KEY = os.environ.get("OPENAI_API_KEY") or "./openai_key.txt"
+LEASES = os.environ.get("TRANSLATION_LEASES") or None
+WORKER = os.environ.get("TRANSLATION_WORKER") or None
+LEASE_ROWS = int(os.environ.get("TRANSLATION_LEASE_ROWS") or 256)
+REQUEST_TIMEOUT = (float(os.environ["TRANSLATION_REQUEST_TIMEOUT"]) if os.environ.get("TRANSLATION_REQUEST_TIMEOUT")
+                   else None)
+HEDGE_BUDGET = float(os.environ.get("TRANSLATION_HEDGE_BUDGET") or 0.0)
+
+
+def state_suffix():
+    """
+    Suffix of the output directory and state files of the run, e.g. ``.mock``.
+
+    Empty for the openai backend, so the outputs of a mock or local run never
+    end up in the checkpoints, cache, translation memory or quota of a real one.
+    """
+    return "" if BACKEND == "openai" else f".{BACKEND}"
+
+
+def state_path(path):
+    """``path`` with the backend suffix before its extension, e.g. ``translation_cache.mock.sqlite``."""
+    stem, dot, extension = path.rpartition(".")
+    return f"{stem}{state_suffix()}.{extension}" if dot else path + state_suffix()
@@ -0,0 +1,124 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+
+
+def json_inputs(source):
+    """Default program inputs: the source fields as one json ``{{input}}``."""
+    return {"input": json.dumps(source)}
+
+
+class DatasetSpec:
+    """
+    Declarative description of one benchmark translation, run by ``runner.run_spec``.
+
+    What is translated:
+
+        path, config      the Hugging Face dataset, ``configs`` runs several
+                          configs (e.g. the MMLU subjects) through one work pool
+        splits            splits to translate, ``limits`` caps rows per split
+        source(example)   the fields sent to the model, ``{field: str or list of str}``
+        fields            expected output schema ``{field: str or list}``, with
+                          ``aliases`` for keys the model translates anyway
+        template          guidance chat template of one request; ``inputs(source)``
+                          fills its variables (default: ``source`` as json ``{{input}}``)
+        target(example, translated)
+                          writes the translation (``None`` for every missing field)
+                          into the output columns
+        validators        ``{name: check(row)}``, a row is translated if every check passes
+        raw_column        column with the raw model output, ``raw_copies`` are further
+                          columns that get the same output (e.g. of a published schema)
+        quality_columns   ``{source column: target column}`` checked by the quality
+                          report after the run, see ``quality.quality_report``;
+                          ``blank`` is a marker every target must keep (e.g. "_________")
+
+    How it is translated:
+
+        max_depth         full re-requests of rows that stay incomplete
+        repair            re-request only the fields that could not be parsed
+        memory_fields     fields looked up in the translation memory and left
+                          out of the prompt when they are already known
+        keep_partial      keep the parsed fields of an incomplete translation
+        review_columns(example, source)
+                          queue rows whose output cannot be parsed at all for
+                          review_queue.py, see ``review_queue.review_item``
+        source_strings(example)
+                          number of strings in the original row, to report how
+                          many the source de-duplicated
+        batch_template    translate several rows per request, ``source`` must
+                          then be a flat ``{field: str}``
+        passthrough_column, passthrough_fields
+                          the entries of this list column that the pre-pass flags
+                          (numbers, formulas, code) are copied into these fields
+                          unchanged
+
+    The remaining options set the model, its rate limits, concurrency and
+    ``request_timeout`` (seconds per request) and where the outputs are
+    written and pushed to.
+    """
+
+    def __init__(self, name, path, template, fields, source, target, config=None, configs=None,
+                 splits=("validation",), limits=None, sample_seed=None, streaming=True, inputs=json_inputs,
+                 aliases=None, validators=None, quality_columns=None, blank=None, raw_column="translation_de",
+                 raw_copies=(), max_depth=0, repair=False,
+                 memory_fields=(), keep_partial=False, review_columns=None, source_strings=None, batch_template=None,
+                 passthrough_column=None, passthrough_fields=(), model_name="gpt-3.5-turbo-0301",
+                 requests_per_min=5000, tokens_per_min=90000, max_concurrency=256, max_in_flight=256,
+                 request_timeout=120, output_dir=None, output_format="jsonl", hub_repo=None):
+        self.name = name
+        self.path = path
+        self.template = template
+        self.fields = fields
+        self.source = source
+        self.target = target
+        self.config = config
+        self.configs = configs
+        self.splits = list(splits)
+        self.limits = limits or {}
+        self.sample_seed = sample_seed
+        self.streaming = streaming
+        self.inputs = inputs
+        self.aliases = aliases
+        self.validators = validators or {}
+        self.quality_columns = quality_columns or {}
+        self.blank = blank
+        self.raw_column = raw_column
+        self.raw_copies = list(raw_copies)
+        self.max_depth = max_depth
+        self.repair = repair
+        self.memory_fields = memory_fields
+        self.keep_partial = keep_partial
+        self.review_columns = review_columns
+        self.source_strings = source_strings
+        self.batch_template = batch_template
+        self.passthrough_column = passthrough_column
+        self.passthrough_fields = passthrough_fields
+        self.model_name = model_name
+        self.requests_per_min = requests_per_min
+        self.tokens_per_min = tokens_per_min
+        self.max_concurrency = max_concurrency
+        self.max_in_flight = max_in_flight
+        self.request_timeout = request_timeout
+        self.output_dir = output_dir or f"outputs_{name}_de"
+        self.output_format = output_format
+        self.hub_repo = hub_repo
+
+    def request_inputs(self, example):
+        return self.inputs(self.source(example))
+
+    def is_translated(self, row):
+        return all(check(row) for check in self.validators.values())
@@ -14,20 +14,11 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-from datasets import load_dataset
-from tqdm import tqdm, trange
-import guidance
-import json
-from pathlib import Path
-from datasets.utils.logging import disable_progress_bar
-import random
-#disable_progress_bar()
-                                                      
-# set the default language model used to execute guidance programs
-guidance.llm = guidance.llms.OpenAI("gpt-3.5-turbo-0301", max_calls_per_min=5000, api_key="./openai_key.txt") 
+from .parsing import HELLASWAG_FIELDS
+from .runner import run_spec
+from .specs import DatasetSpec
 
-structure_program = guidance(
-'''
+structure_template = '''
 {{#system~}}
 You are a helpful assistant that translates json from English to German.
 {{~/system}}
@@ -43,123 +34,43 @@ Be as precise as possible. Keep the exact json format and do not translate the k
 {{#assistant~}}
 {{gen 'output' temperature=0.5 top_p=1}}
 {{~/assistant}}
-''', stream=False)
-
-def fix1(example):
-    translation = example["translation_de"] + "}"
-    try:
-        json.loads(translation)
-        return translation
-    except Exception as e:
-        raise e
-
-def fix2(example):
-    translation = example["translation_de"].replace('"endings":', '"endings": [')
-    try:
-        json.loads(translation)
-        return translation
-    except Exception as e:
-        raise e
-
-def fix3(example):
-    translation = example["translation_de"]
-    if "}" in translation and len(translation.split("}")[1]) > 0:
-        translation = translation.split("}")[0] + "}"
-    try:
-        json.loads(translation)
-        return translation
-    except Exception as e:
-        raise e
-    
-def attempt_fix(example):
-    try:
-        return fix1(example)
-    except Exception as e:
-        try:
-            return fix2(example)
-        except Exception as e:
-            try:
-                return fix3(example)
-            except Exception as e:
-                raise e
-
+'''
 
-def translate_example(example, random_seed=False, depth=0):
-    ex = {
+def source(example):
+    return {
         "activity_label": example["activity_label"],
         "context": example["ctx"],
         "endings": example["endings"]
     }
 
-    try:
-        json_input = json.dumps(ex)
-        if random_seed:
-            out = structure_program(
-                input=json_input,
-                cache_seed=random.randint(0, 100000)
-            )
-        else:
-            out = structure_program(
-                input=json_input
-            )
-    except Exception as e:
-        example["activity_label_de"] = ""
-        example["ctx_de"] = ""
-        example["endings_de"] = ["", "", "", ""]
-        example["translation_de"] = ""
-        return example
-    try:
-        translated = json.loads(out["output"])
-        example["activity_label_de"] = translated["activity_label"]
-        example["ctx_de"] = translated["context"]
-        example["endings_de"] = translated["endings"]
-        example["translation_de"] = out["output"]
-    except Exception as e:
-        try:
-            translated = json.loads(attempt_fix(out))
-            example["activity_label_de"] = translated["activity_label"]
-            example["ctx_de"] = translated["context"]
-            example["endings_de"] = translated["endings"]
-            example["translation_de"] = out["output"]
-        except Exception as e:
-            if depth < 5:
-                return translate_example(example, random_seed=True, depth=depth+1)
-            example["activity_label_de"] = ""
-            example["ctx_de"] = ""
-            example["endings_de"] = ["", "", "", ""]
-            example["translation_de"] = out["output"] if "output" in out else ""
-    return example
-
-
-dataset = load_dataset("hellaswag", split={"train": "train[:1000]", "validation": "validation"})
-
-
-output_dir = Path("outputs_hellaswag_de")
-output_dir.mkdir(exist_ok=True)
-num_shards = 100
-for split in ["train", "validation"]:
-    ds = dataset[split]
-    for i in trange(num_shards, desc=f"Translating {split} shards"):
-        shard = ds.shard(num_shards=num_shards, index=i)
-        shard = shard.map(translate_example, num_proc=32)
-        shard.to_json(output_dir / f"{split}-{i:03d}.json")
-
-# Combine shards
-
-json_files = {
-    "train": [str(x) for x in output_dir.glob(f"train-*.json")],
-    "validation": [str(x) for x in output_dir.glob(f"validation-*.json")]
-}
-dataset = load_dataset("json", data_files=json_files)
-# dataset.to_json(output_dir / "hellaswag_de.json")
-dataset.push_to_hub("bjoernp/hellaswag_de")
-
-for split in ["train", "validation"]:
-    ds = dataset[split]
-    # count examples with empty translation
-    empty = ds.filter(lambda x: x["translation_de"] == "")
-    print(f"Empty translations in {split}: {len(empty)}")
-    # count examples with context translation
-    empty = ds.filter(lambda x: x["ctx_de"] == "")
-    print(f"Empty context translations in {split}: {len(empty)}")
-
+def target(example, translated):
+    example["activity_label_de"] = translated["activity_label"] or ""
+    example["ctx_de"] = translated["context"] or ""
+    example["endings_de"] = translated["endings"] or ["", "", "", ""]
+
+spec = DatasetSpec(
+    name="hellaswag",
+    path="hellaswag",
+    splits=["train", "validation"],
+    # number of train rows to translate, drop the limit to translate the full train split
+    limits={"train": 1000},
+    template=structure_template,
+    fields=HELLASWAG_FIELDS,
+    source=source,
+    target=target,
+    validators={
+        "translation": lambda row: row["translation_de"] != "",
+        "context translation": lambda row: row["ctx_de"] != "",
+    },
+    quality_columns={"activity_label": "activity_label_de", "ctx": "ctx_de", "endings": "endings_de"},
+    max_depth=5,
+    repair=True,
+    # activity labels repeat across thousands of rows, known labels are left out of the prompt
+    memory_fields=["activity_label"],
+    max_in_flight=512,
+    hub_repo="bjoernp/hellaswag_de",
+)
+
+
+if __name__ == "__main__":
+    run_spec(spec)
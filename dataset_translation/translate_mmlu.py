@@ -14,11 +14,9 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-from datasets import load_dataset
-from tqdm import tqdm
-import guidance
-import json
-from pathlib import Path
+from .parsing import MMLU_FIELDS
+from .runner import run_spec
+from .specs import DatasetSpec
 
 _SUBJECTS = [
     "abstract_algebra",
@@ -79,12 +77,8 @@ _SUBJECTS = [
     "virology",
     "world_religions",
 ]
-                                                      
-# set the default language model used to execute guidance programs
-guidance.llm = guidance.llms.OpenAI("gpt-3.5-turbo", max_calls_per_min=1000, api_key=input("API Key: ")) 
 
-structure_program = guidance(
-'''
+structure_template = '''
 {{#system~}}
 You are a helpful assistant that translates questions and answers from English to German.
 {{~/system}}
@@ -125,126 +119,95 @@ Translate only the values and not the keys. "_________" indicate blanks that sho
 {{#assistant~}}
 {{gen 'output' temperature=0 top_p=1 stop="\\n}" max_tokens=1500}}
 {{~/assistant}}
-''', stream=False)
-
-json_format = """
-"question": "{question}",
-"A": "{A}",
-"B": "{B}",
-"C": "{C}",
-"D": "{D}"
-"""
+'''
+
+# translate several questions per request so the system prompt and the one-shot example are sent only once
+batch_translation = True
+
+batch_template = '''
+{{#system~}}
+You are a helpful assistant that translates questions and answers from English to German.
+{{~/system}}
+
+{{#user~}}
+Translate every question and each of its multiple choice answers in the following json list into German. Be as precise as possible. Keep the exact json format and the "id" of every item.
+Translate only the values and not the keys. "_________" indicate blanks that should be kept in the translation. Do not answer anything else than the json list.
+
+[{"id": 0, "question": "How many planets does our solar system have?", "A": "8", "B": "9", "C": "10", "D": "All of the above"}, {"id": 1, "question": "The sun is a _________.", "A": "planet", "B": "star", "C": "moon", "D": "comet"}]
+{{~/user}}
+
+{{#assistant~}}
+[{"id": 0, "question": "Wie viele Planeten hat unser Sonnensystem?", "A": "8", "B": "9", "C": "10", "D": "Alle der oben genannten"}, {"id": 1, "question": "Die Sonne ist ein _________.", "A": "Planet", "B": "Stern", "C": "Mond", "D": "Komet"}]
+{{~/assistant}}
+
+{{#user~}}
+{{#if glossary}}Earlier translations of similar texts, use them for consistent wording:
+{{glossary}}
 
-def contains_json(string):
-    return "{" in string and "}" in string and "\"question\"" in string and "\"A\"" in string and "\"B\"" in string and "\"C\"" in string and "\"D\"" in string
-
-def fix_quotes(string):
-    if string[0] == "\"":
-        string = string[1:]
-    if string[-1] == "\"":
-        string = string[:-1]
-    string = string.replace("\"", "\\\"")
-    string = string.replace("\n", "\\n")
-    return string
-
-def fix_parentheses(string):
-    string = string.replace("{", "\\{")
-    string = string.replace("}", "\\}")
-    return string
-
-def get_question(string):
-    post_question = string.split("\"question\":")[1]
-    question = post_question.split("\"A\"")[0].strip()
-    if question[0] == "\"":
-        question = question[1:]
-    if question[-2:] == "\",":
-        question = question[:-2]
-    question = question.replace("\"", "\\\"")
-    question = question.replace("\n", "\\n")
-    question = question.replace("\\\",\\n\\\"", "\\n")
-    question = fix_parentheses(question)
-    return question
-
-def get_choices(string):
-    choice_A = string.split("\"A\":")[1].split("\"B\"")[0].strip()[:-1]
-    choice_B = string.split("\"B\":")[1].split("\"C\"")[0].strip()[:-1]
-    choice_C = string.split("\"C\":")[1].split("\"D\"")[0].strip()[:-1]
-    choice_D = string.split("\"D\":")[1].split("}")[0].strip()
-    if choice_D.endswith(","):
-        choice_D = choice_D[:-1]
-    fix = lambda x: fix_quotes(fix_parentheses(x))
-    return [fix(choice_A), fix(choice_B), fix(choice_C), fix(choice_D)]
-
-
-def is_valid_json(string):
-    try:
-        json.loads(string)
-        return True
-    except:
-        return False
-    
-def get_json(string):
-    if contains_json(string):
-        question = get_question(string)
-        choices = get_choices(string)
-        json_string = json_format.format(question=question, A=choices[0], B=choices[1], C=choices[2], D=choices[3])
-        json_string = "{" + json_string + "}"
-        if is_valid_json(json_string):
-            return json_string
-        else:
-            return None
-    else:
-        return None
-
-mmlu = {name: load_dataset("tasksource/mmlu", name, split="validation") for name in _SUBJECTS}
-total_len = sum(len(mmlu[name]) for name in _SUBJECTS)
-print(f"Total length: {total_len} examples")
-
-def translate_example(example):
-    question = example["question"]
-    try:
-        out = structure_program(
-            input=question,
-            a=example["choices"][0],
-            b=example["choices"][1],
-            c=example["choices"][2],
-            d=example["choices"][3]
-        )
-    except:
-        example["answer_de"] = out["output"]
-        example["question_de"] = ""
-        example["choices_de"] = ["", "", "", ""]
-    try:
-        translated = json.loads(get_json(out["output"]+"\n}"))
-        example["question_de"] = translated["question"]
-        example["choices_de"] = [translated["A"], translated["B"], translated["C"], translated["D"]]
-        example["answer_de"] = out["output"]+"\n}"
-    except:
-        if "{" in out["output"]:
-            output = "{" + out["output"].split("{")[1]
-            try:
-                translated = json.loads(output)
-                example["question_de"] = translated["question"]
-                example["choices_de"] = [translated["A"], translated["B"], translated["C"], translated["D"]]
-                example["answer_de"] = out["output"]+"\n}"
-            except:
-                example["answer_de"] = out["output"]
-                example["question_de"] = ""
-                example["choices_de"] = ["", "", "", ""]
-        else:
-            example["answer_de"] = out["output"]
-            example["question_de"] = ""
-            example["choices_de"] = ["", "", "", ""]
-    return example
-
-Path("outputs_val_mmlu").mkdir(exist_ok=True)
-# Translate the parts
-for i, name in tqdm(enumerate(_SUBJECTS), total=len(_SUBJECTS)):
-    print(f"Translating {name} ({i+1}/{len(_SUBJECTS)})")
-    part = mmlu[name]
-    part = part.select(range(15)) if len(part) > 15 else part
-    p = part.map(translate_example, num_proc=8)
-    p = p.filter(lambda x: x["question_de"] != "")
-    print(len(p) > 6)
-    p.to_parquet(f"outputs_val_mmlu/{name}.parquet")
+{{/if}}{{input}}
+{{~/user}}
+
+{{#assistant~}}
+{{gen 'output' temperature=0 top_p=1 max_tokens=3000}}
+{{~/assistant}}
+'''
 
+def source(example):
+    return {
+        "question": example["question"],
+        "A": example["choices"][0],
+        "B": example["choices"][1],
+        "C": example["choices"][2],
+        "D": example["choices"][3]
+    }
+
+def inputs(source):
+    # fields known from the translation memory or copied by the pre-pass are missing from the items
+    return {
+        "input": source.get("question", ""),
+        "a": source.get("A", ""),
+        "b": source.get("B", ""),
+        "c": source.get("C", ""),
+        "d": source.get("D", "")
+    }
+
+def target(example, translated):
+    example["question_de"] = translated["question"] or ""
+    example["choices_de"] = [translated[key] or "" for key in "ABCD"]
+
+spec = DatasetSpec(
+    name="mmlu",
+    path="tasksource/mmlu",
+    configs=_SUBJECTS,
+    # number of validation rows per subject to translate, drop the limit to translate every row
+    limits={"validation": 15},
+    # None takes the first rows, a seed draws a random sample instead
+    sample_seed=None,
+    streaming=False,
+    template=structure_template,
+    inputs=inputs,
+    fields=MMLU_FIELDS,
+    source=source,
+    target=target,
+    validators={"question translation": lambda row: row["question_de"] != ""},
+    quality_columns={"question": "question_de", "choices": "choices_de"},
+    # fill-in-the-blank questions must keep their blank
+    blank="_________",
+    raw_column="answer_de",
+    batch_template=batch_template if batch_translation else None,
+    # options like numbers, formulas or code are copied unchanged
+    passthrough_column="choices",
+    passthrough_fields=["A", "B", "C", "D"],
+    model_name="gpt-3.5-turbo",
+    requests_per_min=1000,
+    max_concurrency=128,
+    max_in_flight=128,
+    # answers of up to 1500 tokens take minutes
+    request_timeout=300,
+    output_dir="outputs_val_mmlu",
+    output_format="parquet",
+)
+
+
+if __name__ == "__main__":
+    run_spec(spec)
@@ -0,0 +1,148 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import hashlib
+import re
+import sqlite3
+import time
+import zlib
+from .rate_limit import estimate_tokens
+
+_SPACES = re.compile(r"\s+")
+_NUM_PERMUTATIONS = 32
+_BANDS = 8
+
+
+def normalize(text):
+    return _SPACES.sub(" ", text).strip()
+
+
+def _hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _shingles(text, n=3):
+    text = normalize(text).lower()
+    return {text[i:i + n] for i in range(max(1, len(text) - n + 1))}
+
+
+def _minhash(shingles):
+    encoded = [shingle.encode("utf-8") for shingle in shingles]
+    return [min(zlib.crc32(shingle, seed) for shingle in encoded) for seed in range(1, _NUM_PERMUTATIONS + 1)]
+
+
+def _bands(signature):
+    rows = _NUM_PERMUTATIONS // _BANDS
+    return [f"{band}:" + ",".join(map(str, signature[band * rows:(band + 1) * rows])) for band in range(_BANDS)]
+
+
+class TranslationMemory:
+    """
+    Segment-level English -> German translation memory shared by all scripts.
+
+    Exact (and whitespace-normalized) lookups return a stored translation so
+    the segment does not have to be sent to the model again. With
+    ``near_duplicates`` a MinHash/LSH index over character trigrams finds
+    similar segments whose translations can be passed to the model as hints.
+    """
+
+    def __init__(self, path="translation_memory.sqlite", near_duplicates=True, threshold=0.7):
+        self.near_duplicates = near_duplicates
+        self.threshold = threshold
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS segments (hash TEXT PRIMARY KEY, normalized_hash TEXT, "
+            "source TEXT, target TEXT, dataset TEXT, created REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS segments_normalized ON segments (normalized_hash)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS bands (band TEXT, hash TEXT)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS bands_band ON bands (band)")
+        self.lookups = 0
+        self.hits = 0
+        self.hint_lookups = 0
+        self.hint_hits = 0
+        self.tokens_avoided = 0
+
+    def lookup(self, text):
+        """Return the stored translation of ``text`` or ``None``."""
+        self.lookups += 1
+        row = self.conn.execute("SELECT target FROM segments WHERE hash = ?", (_hash(text),)).fetchone()
+        if row is None:
+            row = self.conn.execute("SELECT target FROM segments WHERE normalized_hash = ? LIMIT 1",
+                                    (_hash(normalize(text)),)).fetchone()
+        if row is None:
+            return None
+        self.hits += 1
+        # the segment is neither sent nor generated
+        self.tokens_avoided += 2 * estimate_tokens(text)
+        return row[0]
+
+    def hints(self, text, limit=3):
+        """Return up to ``limit`` ``(source, target)`` pairs of stored segments similar to ``text``."""
+        if not self.near_duplicates:
+            return []
+        self.hint_lookups += 1
+        shingles = _shingles(text)
+        bands = _bands(_minhash(shingles))
+        candidates = self.conn.execute(
+            "SELECT DISTINCT s.source, s.target FROM bands b JOIN segments s ON s.hash = b.hash "
+            f"WHERE b.band IN ({','.join('?' * len(bands))})", bands
+        ).fetchall()
+        scored = []
+        for source, target in candidates:
+            if source == text:
+                continue
+            other = _shingles(source)
+            similarity = len(shingles & other) / len(shingles | other)
+            if similarity >= self.threshold:
+                scored.append((similarity, source, target))
+        scored.sort(reverse=True)
+        if scored:
+            self.hint_hits += 1
+        return [(source, target) for _, source, target in scored[:limit]]
+
+    def add(self, source, target, dataset=""):
+        if not source or not target:
+            return
+        key = _hash(source)
+        inserted = self.conn.execute(
+            "INSERT OR IGNORE INTO segments VALUES (?, ?, ?, ?, ?, ?)",
+            (key, _hash(normalize(source)), source, target, dataset, time.time()),
+        ).rowcount
+        if inserted and self.near_duplicates:
+            self.conn.executemany("INSERT INTO bands VALUES (?, ?)",
+                                  [(band, key) for band in _bands(_minhash(_shingles(source)))])
+
+    def add_segments(self, source, translated, dataset=""):
+        """Store every string (or list of strings) of ``source`` with its counterpart in ``translated``."""
+        for field, value in source.items():
+            target = translated.get(field)
+            if isinstance(value, list):
+                if isinstance(target, list) and len(target) == len(value):
+                    for item, item_target in zip(value, target):
+                        self.add(item, item_target, dataset)
+            elif isinstance(value, str) and isinstance(target, str):
+                self.add(value, target, dataset)
+
+    def summary(self):
+        rate = self.hits / self.lookups if self.lookups else 0.0
+        text = (f"Translation memory: {self.hits}/{self.lookups} segment hits ({rate:.0%}), "
+                f"~{self.tokens_avoided} tokens avoided")
+        if self.hint_lookups:
+            text += f", near-duplicate hints for {self.hint_hits}/{self.hint_lookups} segments"
+        return text
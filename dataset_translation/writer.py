@@ -0,0 +1,194 @@
+"""
+Copyright 2023 Björn Plüster
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import os
+from pathlib import Path
+
+INDEX_COLUMN = "_source_index"
+
+
+def empty_table():
+    """The table of a split with no rows written yet, only the index column is known."""
+    import pyarrow as pa
+    return pa.table({INDEX_COLUMN: pa.array([], pa.int64())})
+
+
+def combine_tables(tables):
+    """Concatenate written tables, keeping the last copy of every index, in source order."""
+    import pyarrow as pa
+    tables = [table for table in tables if table.num_rows]
+    if not tables:
+        return empty_table()
+    table = pa.concat_tables(tables)
+    indices = table[INDEX_COLUMN].to_pylist()
+    last = {index: position for position, index in enumerate(indices)}
+    return table.take([last[index] for index in sorted(last)])
+
+
+def split_writers(output_dir, split, format="jsonl"):
+    """The writers of ``split``, one per leased range (``<output_dir>/ranges/<split>-<start>``) for a leased run."""
+    output_dir = Path(output_dir)
+    ranges = sorted((output_dir / "ranges").glob(f"{split}-*.done"))
+    if not ranges:
+        return [AppendOnlyWriter(output_dir, split, format=format)]
+    return [AppendOnlyWriter(output_dir / "ranges", path.stem, format=format) for path in ranges]
+
+
+def _drop_partial_line(path):
+    """Cut ``path`` back to its last newline, dropping a line a crash left half written."""
+    if not path.exists():
+        return
+    with open(path, "rb+") as f:
+        end = position = f.seek(0, os.SEEK_END)
+        while position > 0:
+            start = max(0, position - 65536)
+            f.seek(start)
+            newline = f.read(position - start).rfind(b"\n")
+            if newline >= 0:
+                position = start + newline + 1
+                break
+            position = start
+        if position < end:
+            f.truncate(position)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def to_dataset(table):
+    """A written table as a Dataset, without the index column."""
+    from datasets import Dataset
+    if INDEX_COLUMN in table.column_names:
+        table = table.remove_column(table.schema.get_field_index(INDEX_COLUMN))
+    return Dataset(table)
+
+
+class AppendOnlyWriter:
+    """
+    Crash-safe, append-only output for one split.
+
+    Finished rows are buffered and flushed every ``flush_every`` rows, either
+    as lines of ``<split>.jsonl`` or as one ``<split>-<part>.parquet`` row
+    group file per flush. Each flush is fsync'd before the source indices it
+    contains are appended to the ``<split>.done`` checkpoint, so after a
+    crash ``done`` never claims a row that is not on disk. A line cut off by
+    a crash is dropped when the split is opened again. Rows written but not
+    yet checkpointed are simply translated again and de-duplicated by
+    ``merge()``.
+    """
+
+    def __init__(self, output_dir, split, format="jsonl", flush_every=64):
+        if format not in ("jsonl", "parquet"):
+            raise ValueError(f"Unknown output format: {format}")
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.split = split
+        self.format = format
+        self.flush_every = flush_every
+        self.checkpoint_path = self.output_dir / f"{split}.done"
+        # a crash may have cut off the last line, new lines must not be appended onto it
+        _drop_partial_line(self.checkpoint_path)
+        if format == "jsonl":
+            _drop_partial_line(self.output_dir / f"{split}.jsonl")
+        self.done = set()
+        if self.checkpoint_path.exists():
+            with open(self.checkpoint_path) as f:
+                self.done = {int(line) for line in f}
+        self.buffer = []
+        self._file = None
+        self._schema = None
+        self._part = len(list(self.output_dir.glob(f"{split}-*.parquet")))
+
+    def __call__(self, index, row):
+        self.buffer.append((index, row))
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        rows = [{**row, INDEX_COLUMN: index} for index, row in self.buffer]
+        if self.format == "jsonl":
+            self._write_jsonl(rows)
+        else:
+            self._write_parquet(rows)
+        with open(self.checkpoint_path, "a") as f:
+            f.write("".join(f"{index}\n" for index, _ in self.buffer))
+            f.flush()
+            os.fsync(f.fileno())
+        self.done.update(index for index, _ in self.buffer)
+        self.buffer = []
+
+    def _write_jsonl(self, rows):
+        if self._file is None:
+            self._file = open(self.output_dir / f"{self.split}.jsonl", "a", encoding="utf-8")
+        self._file.write("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _write_parquet(self, rows):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pylist(rows, schema=self._schema)
+        self._schema = table.schema
+        # a parquet file is only readable once its footer is written, so every
+        # flush becomes one small row group file that is renamed into place
+        path = self.output_dir / f"{self.split}-{self._part:05d}.parquet"
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            pq.write_table(table, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self._part += 1
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def table(self):
+        """Everything written for this split as one pyarrow Table in source order, with ``INDEX_COLUMN``."""
+        import pyarrow as pa
+        if self.format == "jsonl":
+            rows = {}
+            path = self.output_dir / f"{self.split}.jsonl"
+            if path.exists():
+                with open(path, encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            row = json.loads(line)
+                        except json.JSONDecodeError:
+                            continue
+                        rows[row[INDEX_COLUMN]] = row
+            if not rows:
+                return empty_table()
+            return pa.Table.from_pylist([rows[index] for index in sorted(rows)])
+        import pyarrow.parquet as pq
+        return combine_tables([pq.read_table(path, memory_map=True)
+                               for path in sorted(self.output_dir.glob(f"{self.split}-*.parquet"))])
+
+    def latest_rows(self):
+        """Return ``{source index: row}`` with the most recently written version of every row."""
+        rows = {}
+        for row in self.table().to_pylist():
+            rows[row.pop(INDEX_COLUMN)] = row
+        return rows
+
+    def merge(self, table=None):
+        """Combine everything written for this split into one Dataset in source order, reusing ``table`` if given."""
+        return to_dataset(self.table() if table is None else table)